@@ -10,7 +10,7 @@
 #
 
 import os
-from os.path import exists, join, isdir
+from os.path import exists, lexists, join
 
 import stat
 
@@ -18,15 +18,17 @@ import shutil
 import simplejson
 
 from paths import Paths
+from temp import TempFile
 
-from dirindex import read_paths
-from changes import whatchanged
+import deltafile
+from dirindex import read_paths, DirCache, HashCache
+from changes import Changes, ChangesFile, iterchanges, iterolist
 from pkgman import Packages
 
 import mysql
 import pgsql
 
-from utils import AttrDict, fmt_title, apply_overlay
+from utils import AttrDict, fmt_title, apply_overlay, remove_any
 
 class ProfilePaths(Paths):
     files = [ 'dirindex', 'dirindex.conf', 'packages' ]
@@ -42,7 +44,8 @@ class ExtrasPaths(Paths):
     def __new__(cls, root_path=None):
         return str.__new__(cls, root_path)
 
-    files = [ 'backup-conf', 'fsdelta', 'fsdelta-olist', 'newpkgs', 'pgfs', 'myfs', 'etc', 'etc/mysql' ]
+    files = [ 'backup-conf', 'fsdelta', 'fsdelta-olist', 'newpkgs', 'pgfs', 'myfs', 'etc', 'etc/mysql',
+              'checkpoints' ]
 
 def _rmdir(path):
     if exists(path):
@@ -55,9 +58,6 @@ def _fpaths(dpath):
             arr.append(join(dpath, fname))
     return arr
 
-def _filter_deleted(files):
-    return [ f for f in files if exists(f) ]
-
 
 class BackupConf(AttrDict):
     def __init__(self, profile_id, overrides, skip_files, skip_packages, skip_database):
@@ -108,98 +108,171 @@ class Backup:
         paths = read_paths(file(dirindex_conf))
         paths += overrides
 
-        changes = whatchanged(dirindex, paths)
-        changes.sort(lambda a,b: cmp(a.path, b.path))
+        # directory listings are only cached by serial scans
+        dircache = None
+        if self.dircache and self.scan_workers <= 1:
+            st = os.stat(dirindex)
+            dircache = DirCache(self.dircache, (dirindex, st.st_size, st.st_mtime, paths))
 
-        changes.tofile(dest)
-        olist = [ change.path for change in changes if change.OP == 'o' ]
-        file(dest_olist, "w").writelines((path + "\n" for path in olist))
+        hashcache = HashCache(self.hashcache) if self.hashcache else None
 
-        if self.verbose:
-            if changes:
-                self._log("Save list of filesystem changes to %s:\n" % dest)
+        olist_stats = [ 0, 0 ]
+        def tally(changes):
+            for change in changes:
+                if change.OP == 'o':
+                    olist_stats[0] += 1
+                    olist_stats[1] += change.size
+                yield change
+
+        # changes are streamed to disk in path order, not held in memory
+        changes = iterchanges(dirindex, paths, self.scan_workers, dircache, hashcache,
+                              tmpdir=os.path.dirname(dest))
+        deltafile.write(dest, ( str(change) + "\n" for change in tally(changes) ), 1)
+
+        if dircache:
+            dircache.save()
+        if hashcache:
+            hashcache.save()
 
-            actions = list(changes.deleted(optimized=False)) + list(changes.statfixes(optimized=False))
-            actions.sort(lambda a,b: cmp(a.args[0], b.args[0]))
+        # new directories are included whole, fsdelta stays exact
+        changes = ChangesFile(dest)
+        deltafile.write(dest_olist, iterolist(changes, dirindex, paths,
+                                              tmpdir=os.path.dirname(dest)))
 
+        # from the scan, for the backup size summary
+        self.olist_stats = tuple(olist_stats)
+
+        if self.verbose:
             umask = os.umask(0)
             os.umask(umask)
 
-            for action in actions:
-                if action.func is os.chmod:
-                    path, mode = action.args
-                    default_mode = (0777 if isdir(path) else 0666) ^ umask
-                    if default_mode == stat.S_IMODE(mode):
-                        continue
-                elif action.func is os.lchown:
-                    path, uid, gid = action.args
-                    if uid == 0 and gid == 0:
-                        continue
+            for i, change in enumerate(changes):
+                if i == 0:
+                    self._log("Save list of filesystem changes to %s:\n" % dest)
+
+                single = Changes([ change ])
+                actions = list(single.deleted(optimized=False)) + \
+                          list(single.statfixes(optimized=False))
 
-                self._log("  " + str(action))
+                for action in actions:
+                    if action.func is os.chmod:
+                        path, mode = action.args
+                        default_mode = (0777 if stat.S_ISDIR(change.mode) else 0666) ^ umask
+                        if default_mode == stat.S_IMODE(mode):
+                            continue
+                    elif action.func is os.lchown:
+                        path, uid, gid = action.args
+                        if uid == 0 and gid == 0:
+                            continue
 
-            if olist:
+                    self._log("  " + str(action))
+
+            if olist_stats[0]:
                 self._log("\nSave list of new files to %s:\n" % dest_olist)
-                for path in olist:
-                    self._log("  " + path)
+                for line in deltafile.iterlines(dest_olist):
+                    self._log("  " + line.rstrip("\n"))
+
+    def _stage(self, extras, name, outputs, func, *args):
+        """Run func(*args) as stage name, unless a previous (resumed) session
+        already completed it. Outputs left by an interrupted run of the stage
+        are removed first. Completion is marked by atomically creating a
+        checkpoint file"""
+
+        checkpoint = join(extras.checkpoints, name)
+        if exists(checkpoint):
+            self._log("\n// skipping %s, completed by the resumed session" % name)
+            return
+
+        for output in outputs:
+            remove_any(output)
+
+        func(*args)
+
+        file(checkpoint + ".tmp", "w").close()
+        os.rename(checkpoint + ".tmp", checkpoint)
 
     def _create_extras(self, extras, profile, conf):
-        os.mkdir(extras.path)
-        os.chmod(extras.path, 0700)
+        if not exists(extras.path):
+            os.mkdir(extras.path)
+            os.chmod(extras.path, 0700)
 
-        etc = str(extras.etc)
-        os.mkdir(etc)
-        self._log("  mkdir " + etc)
+            os.mkdir(extras.checkpoints)
+            conf.tofile(extras.backup_conf)
 
-        self._log("\n// needed to automatically detect and fix file ownership issues\n")
+        def copy_etc():
+            etc = str(extras.etc)
+            if not exists(etc):
+                os.mkdir(etc)
+                self._log("  mkdir " + etc)
 
-        shutil.copy("/etc/passwd", etc)
-        self._log("  cp /etc/passwd " + etc)
+            self._log("\n// needed to automatically detect and fix file ownership issues\n")
 
-        shutil.copy("/etc/group", etc)
-        self._log("  cp /etc/group " + etc)
+            shutil.copy("/etc/passwd", etc)
+            self._log("  cp /etc/passwd " + etc)
+
+            shutil.copy("/etc/group", etc)
+            self._log("  cp /etc/group " + etc)
+
+        self._stage(extras, 'etc', [], copy_etc)
 
         if not conf.skip_packages or not conf.skip_files:
             self._log("\n" + fmt_title("Comparing current system state to the base state in the backup profile", '-'))
 
         if not conf.skip_packages and exists(profile.packages):
-            self._write_new_packages(extras.newpkgs, profile.packages)
+            self._stage(extras, 'newpkgs', [ extras.newpkgs ],
+                        self._write_new_packages, extras.newpkgs, profile.packages)
 
         if not conf.skip_files:
             # support empty profiles
             dirindex = profile.dirindex if exists(profile.dirindex) else "/dev/null"
             dirindex_conf = profile.dirindex_conf if exists(profile.dirindex_conf) else "/dev/null"
 
-            self._write_whatchanged(extras.fsdelta, extras.fsdelta_olist,
-                                    dirindex, dirindex_conf,
-                                    conf.overrides.fs)
+            self._stage(extras, 'fsdelta', [ extras.fsdelta, extras.fsdelta_olist ],
+                        self._write_whatchanged, extras.fsdelta, extras.fsdelta_olist,
+                        dirindex, dirindex_conf, conf.overrides.fs)
 
         if not conf.skip_database:
 
-            try:
-                if mysql.MysqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
-                    mysql.backup(extras.myfs, extras.etc.mysql,
-                                 limits=conf.overrides.mydb, callback=mysql.cb_print()) if self.verbose else None
-
-            except mysql.Error:
-                pass
-
-            try:
-                if pgsql.PgsqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
-                    pgsql.backup(extras.pgfs, conf.overrides.pgdb, callback=pgsql.cb_print() if self.verbose else None)
-            except pgsql.Error:
-                pass
+            def backup_mysql():
+                try:
+                    if mysql.MysqlService.is_running():
+                        self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
+                        mysql.backup(extras.myfs, extras.etc.mysql,
+                                     limits=conf.overrides.mydb, callback=mysql.cb_print() if self.verbose else None,
+                                     workers=self.mysql_dump_workers,
+                                     cache=mysql.RowsCache(self.mysqlcache) if self.mysqlcache else None,
+                                     tsv=self.mysql_rows_tsv)
+
+                except mysql.Error:
+                    pass
+
+            def backup_pgsql():
+                try:
+                    if pgsql.PgsqlService.is_running():
+                        self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
+                        pgsql.backup(extras.pgfs, conf.overrides.pgdb, callback=pgsql.cb_print() if self.verbose else None)
+                except pgsql.Error:
+                    pass
+
+            self._stage(extras, 'myfs', [ extras.myfs, extras.etc.mysql ], backup_mysql)
+            self._stage(extras, 'pgfs', [ extras.pgfs ], backup_pgsql)
 
     def _log(self, s=""):
         if self.verbose:
             print s
 
     def __init__(self, profile, overrides, 
-                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/"):
+                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/",
+                 scan_workers=1, dircache=None, hashcache=None, mysql_dump_workers=1, mysqlcache=None,
+                 mysql_rows_tsv=False):
 
         self.verbose = verbose
+        self.scan_workers = scan_workers
+        self.mysql_dump_workers = mysql_dump_workers
+        self.mysqlcache = mysqlcache
+        self.mysql_rows_tsv = mysql_rows_tsv
+        self.dircache = dircache
+        self.hashcache = hashcache
 
         if not profile:
             raise self.Error("can't backup without a profile")
@@ -209,6 +282,7 @@ class Backup:
 
         # decide whether we can allow resume=True
         # /TKLBAM has to exist and the backup configuration has to match
+        # (it's saved first, so this includes extras we didn't finish)
         backup_conf = BackupConf(profile.profile_id,
                                  overrides,
                                  skip_files,
@@ -226,33 +300,40 @@ class Backup:
             self._log("ATTEMPTING TO RESUME ABORTED BACKUP SESSION")
 
         self.resume = resume
+        self.olist_stats = None
 
-        # create or re-use /TKLBAM
-        if not exists(extras_paths.path):
-
-            self._log(fmt_title("Creating %s (contains backup metadata and database dumps)" % extras_paths.path))
-            self._log("  mkdir -p " + extras_paths.path)
+        # create or re-use /TKLBAM. Until it's complete, checkpoints record
+        # which stages are done, so a resumed session only repeats the rest
+        if not exists(extras_paths.path) or exists(extras_paths.checkpoints):
+            if exists(extras_paths.path):
+                self._log(fmt_title("Resuming creation of %s" % extras_paths.path))
+            else:
+                self._log(fmt_title("Creating %s (contains backup metadata and database dumps)" % extras_paths.path))
+                self._log("  mkdir -p " + extras_paths.path)
 
-            try:
-                self._create_extras(extras_paths, profile_paths, backup_conf)
-                backup_conf.tofile(extras_paths.backup_conf)
-            except:
-                # destroy potentially incomplete extras
-                _rmdir(extras_paths.path)
-                raise
+            self._create_extras(extras_paths, profile_paths, backup_conf)
+            _rmdir(extras_paths.checkpoints)
 
         # print uncompressed footprint
         if verbose:
 
             # files in /TKLBAM + /TKLBAM/fsdelta-olist
             fpaths= _fpaths(extras_paths.path)
+            files = len(fpaths)
+            size = sum([ os.lstat(fpath).st_size for fpath in fpaths ])
 
             if not skip_files:
-                fsdelta_olist = file(extras_paths.fsdelta_olist).read().splitlines()
-                fpaths += _filter_deleted(fsdelta_olist)
-
-            size = sum([ os.lstat(fpath).st_size
-                         for fpath in fpaths ])
+                # resumed sessions didn't scan for the olist. The olist
+                # may have collapsed directories, fsdelta has their files
+                olist_stats = self.olist_stats
+                if olist_stats is None:
+                    olist_sizes = [ os.lstat(change.path).st_size
+                                    for change in ChangesFile(extras_paths.fsdelta)
+                                    if change.OP == 'o' and lexists(change.path) ]
+                    olist_stats = (len(olist_sizes), sum(olist_sizes))
+
+                files += olist_stats[0]
+                size += olist_stats[1]
 
             if size > 1024 * 1024 * 1024:
                 size_fmt = "%.2f GB" % (float(size) / (1024 * 1024 * 1024))
@@ -261,13 +342,27 @@ class Backup:
             else:
                 size_fmt = "%.2f KB" % (float(size) / 1024)
 
-            self._log("\nUNCOMPRESSED BACKUP SIZE: %s in %d files" % (size_fmt, len(fpaths)))
+            self._log("\nUNCOMPRESSED BACKUP SIZE: %s in %d files" % (size_fmt, files))
 
         self.extras_paths = extras_paths
 
+    def filelist(self):
+        """Returns a temporary plain text copy of fsdelta-olist (e.g., for
+        duplicity --include-filelist), or None if there is no olist"""
+
+        if not exists(self.extras_paths.fsdelta_olist):
+            return None
+
+        tmp = TempFile("fsdelta-olist-")
+        tmp.writelines(deltafile.iterlines(self.extras_paths.fsdelta_olist))
+        tmp.close()
+
+        return tmp
+
     def dump(self, path):
         def r(p):
             return join(path, p.lstrip('/'))
 
-        if exists(self.extras_paths.fsdelta_olist):
-            apply_overlay('/', path, self.extras_paths.fsdelta_olist)
+        filelist = self.filelist()
+        if filelist:
+            apply_overlay('/', path, filelist.path)
@@ -8,12 +8,15 @@
 # published by the Free Software Foundation; either version 3 of
 # the License, or (at your option) any later version.
 #
-import sys
 import os
+import sys
 from os.path import *
 
-import types
+import threading
+from Queue import Queue
 
+import dirindex
+import deltafile
 from dirindex import DirIndex
 from pathmap import PathMap
 
@@ -23,20 +26,93 @@ import errno
 import pwd
 import grp
 
+import userdb
+
 class Error(Exception):
     pass
 
+# number of threads that apply actions in parallel
+APPLY_WORKERS = 4
+
+# actions that paths beneath their path don't depend on, and vice versa
+# (e.g., unlike a mkdir, a chmod doesn't need to wait or be waited for)
+_UNORDERED = (os.lchown, os.chmod, os.remove)
+
+class IdNames:
+    """Cache of user and group names by id.
+
+    Names come from passwd and group databases (userdb.EtcPasswd and
+    userdb.EtcGroup, read from /etc by default) which are loaded once. NSS
+    (e.g., LDAP, sssd) is only queried for ids they don't have.
+    """
+    def __init__(self, passwd=None, group=None):
+        def read(cls, path):
+            try:
+                return cls(file(path).read())
+            except (IOError, ValueError, userdb.Error):
+                return cls()
+
+        if passwd is None:
+            passwd = read(userdb.EtcPasswd, "/etc/passwd")
+
+        if group is None:
+            group = read(userdb.EtcGroup, "/etc/group")
+
+        self.users = self._names(passwd)
+        self.groups = self._names(group)
+
+    @staticmethod
+    def _names(db):
+        # like NSS, the first entry with an id wins
+        names = {}
+        for name in db:
+            # NIS compat entries (e.g., +::::::) have no id
+            try:
+                id = db[name].id
+            except ValueError:
+                continue
+
+            names.setdefault(id, name)
+
+        return names
+
+    def uid(self, uid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except:
+                self.users[uid] = str(uid)
+
+        return self.users[uid]
+
+    def gid(self, gid):
+        if gid not in self.groups:
+            try:
+                self.groups[gid] = grp.getgrgid(gid).gr_name
+            except:
+                self.groups[gid] = str(gid)
+
+        return self.groups[gid]
+
+_idnames = None
+
+def set_userdb(passwd, group):
+    """format ids with names from passwd and group (e.g., merged userdb)"""
+    global _idnames
+    _idnames = IdNames(passwd, group)
+
+def _get_idnames():
+    global _idnames
+    if _idnames is None:
+        _idnames = IdNames()
+
+    return _idnames
+
 def fmt_uid(uid):
-    try:
-        return pwd.getpwuid(uid).pw_name
-    except:
-        return str(uid)
+    return _get_idnames().uid(uid)
 
 def fmt_gid(gid):
-    try:
-        return grp.getgrgid(gid).gr_name
-    except:
-        return str(gid)
+    return _get_idnames().gid(gid)
 
 class Change:
     """
@@ -85,9 +161,12 @@ class Change:
 
     class Overwrite(Base):
         OP = 'o'
-        def __init__(self, path, uid=None, gid=None):
+        def __init__(self, path, uid=None, gid=None, size=None):
             Change.Base.__init__(self, path)
 
+            # not saved, only known if we created the change from a stat
+            self.size = size
+
             if uid is None:
                 self.uid = self.stat.st_uid
             else:
@@ -116,15 +195,30 @@ class Change:
         def __str__(self):
             return self.fmt(self.uid, self.gid, oct(self.mode))
 
+    # dispatch table for parse()
+    OPS = dict((val.OP, val) for val in (Deleted, Overwrite, Stat))
+
     @classmethod
     def parse(cls, line):
-        op2class = dict((val.OP, val) for val in cls.__dict__.values()
-                        if isinstance(val, types.ClassType))
         op = line[0]
-        if op not in op2class:
+        if op not in cls.OPS:
             raise Error("illegal change line: " + line)
 
-        return op2class[op].fromline(line[2:])
+        return cls.OPS[op].fromline(line[2:])
+
+def iterparse(lines, paths=None):
+    """parse fsdelta lines lazily and yield Change() instances, limited to
+    paths if provided"""
+
+    pathmap = PathMap(paths) if paths else None
+    parse = Change.parse
+
+    for line in lines:
+        change = parse(line)
+        if pathmap and change.path not in pathmap:
+            continue
+
+        yield change
 
 def mkdir(path):
     try:
@@ -176,21 +270,15 @@ class Changes(list):
 
     @classmethod
     def fromfile(cls, f, paths=None):
-        if f == '-':
-            fh = sys.stdin
-        else:
-            fh = file(f)
-
-        changes = [ Change.parse(line) for line in fh.readlines() ]
-        if paths:
-            pathmap = PathMap(paths)
-            changes = [ change for change in changes
-                        if change.path in pathmap ]
+        """load packed or text fsdelta (- for stdin)"""
+        return cls(iterparse(deltafile.iterlines(f, 1), paths))
 
-        return cls(changes)
-
-    def tofile(self, f):
-        file(f, "w").writelines((str(change) + "\n" for change in self))
+    def tofile(self, f, packed=False):
+        lines = (str(change) + "\n" for change in self)
+        if packed:
+            deltafile.write(f, lines, 1)
+        else:
+            file(f, "w").writelines(lines)
 
     def deleted(self, optimized=True):
         for change in self:
@@ -236,7 +324,7 @@ class Changes(list):
                change.uid not in uidmap and change.gid not in gidmap:
                 continue
 
-            st = os.lstat(change.path)
+            st = os.lstat(change.path) if optimized else None
             if change.OP in ('s', 'o'):
                 if not optimized or \
                    (st.st_uid != uidmap[change.uid] or \
@@ -251,23 +339,287 @@ class Changes(list):
                      stat.S_IMODE(st.st_mode) != stat.S_IMODE(change.mode)):
                     yield self.Action(os.chmod, change.path, stat.S_IMODE(change.mode))
 
-def whatchanged(di_path, paths):
-    """Compared current filesystem with a saved dirindex from before.
-       Returns a Changes() list."""
+def apply_actions(actions, workers=APPLY_WORKERS, callback=None):
+    """Run actions (e.g., from Changes.statfixes or Changes.deleted).
+
+    Consecutive actions in the same directory are batched and batches run
+    in parallel on a pool of worker threads. Actions on the same path are
+    always in the same batch, so they run in order (e.g., mkdir before
+    lchown and chmod).
+
+    Other actions run in order relative to the paths beneath their path
+    (e.g., mkdir of a directory before anything in it, or removing a
+    directory's contents before the directory), so a batch that would
+    break that order waits for the running batches to finish first.
+    Chown, chmod and remove of a file don't need this.
+
+    If provided, callback(action) is called for every action in the
+    original order before it runs. The first exception raised by an action
+    stops the run and is re-raised."""
+
+    BATCH_SIZE = 256
+
+    if workers <= 1:
+        for action in actions:
+            if callback:
+                callback(action)
+            action()
+        return
+
+    # bounded so we don't read far ahead of the workers
+    queue = Queue(workers * 2)
+    errors = []
+
+    # what queued and running batches hold: their directory and its parents
+    # as ('dir', path), and the paths of their ordered actions as ('path',
+    # path). Counted because batches can hold the same directories
+    held = {}
+    lock = threading.Lock()
+
+    def hold(keys, n):
+        lock.acquire()
+        try:
+            for key in keys:
+                held[key] = held.get(key, 0) + n
+                if not held[key]:
+                    del held[key]
+        finally:
+            lock.release()
+
+    def keys(batch):
+        keys = set()
+
+        dir = dirname(batch[0].args[0])
+        while True:
+            keys.add(('dir', dir))
+            if dir == dirname(dir):
+                break
+            dir = dirname(dir)
+
+        for action in batch:
+            if action.func not in _UNORDERED:
+                keys.add(('path', action.args[0]))
+
+        return keys
+
+    def conflicts(keys):
+        # beneath a held path, or a path above a held directory
+        for kind, path in keys:
+            other = ('path', path) if kind == 'dir' else ('dir', path)
+            if other in held:
+                return True
+
+        return False
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                return
+
+            batch, batch_keys = item
+            for action in batch:
+                if errors:
+                    break
+
+                try:
+                    action()
+                except:
+                    errors.append(sys.exc_info())
+
+            hold(batch_keys, -1)
+            queue.task_done()
+
+    def put(batch):
+        batch_keys = keys(batch)
+        if conflicts(batch_keys):
+            queue.join()
+
+        hold(batch_keys, 1)
+        queue.put((batch, batch_keys))
+
+    threads = [ threading.Thread(target=worker) for i in range(workers) ]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        batch = []
+        for action in actions:
+            if errors:
+                break
+
+            if callback:
+                callback(action)
+
+            path = action.args[0]
+            if batch:
+                prev = batch[-1].args[0]
+                if dirname(path) != dirname(prev) or \
+                   (len(batch) >= BATCH_SIZE and path != prev):
+                    put(batch)
+                    batch = []
+
+            batch.append(action)
+
+        if batch:
+            put(batch)
+
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+class ChangesFile:
+    """
+    Changes read lazily from an fsdelta file, which is parsed again every
+    time we iterate over it. Memory use doesn't grow with the size of the
+    fsdelta.
+
+    Supports the same deleted(), statfixes() and tofile() methods as
+    Changes(). Stdin ('-') can only be iterated over once.
+    """
+    Action = Changes.Action
+
+    def __init__(self, f, paths=None):
+        self.f = f
+        self.paths = paths
+
+    def __iter__(self):
+        return iterparse(deltafile.iterlines(self.f, 1), self.paths)
+
+    tofile = Changes.tofile.im_func
+    deleted = Changes.deleted.im_func
+    statfixes = Changes.statfixes.im_func
+
+def iterchanges(di_path, paths, scan_workers=DirIndex.SCAN_WORKERS, dircache=None,
+                hashcache=None, tmpdir=None):
+    """Compare current filesystem with a saved dirindex from before.
+       Yields Change() instances in path order.
+
+       Changes are created from the records of the scan, so changed paths
+       aren't lstat'ed again.
+
+       The scan is streamed against the saved dirindex so memory use doesn't
+       grow with the number of files. Parallel scans aren't ordered so they
+       are sorted externally, spilling sorted runs to tmpdir.
+
+       Serial scans use and update dircache (a dirindex.DirCache) if
+       provided.
+
+       If the saved dirindex has content digests, files that were rewritten
+       with the same content aren't changed. Digests are looked up in
+       hashcache (a dirindex.HashCache) if provided."""
+
+    current = dirindex.iterwalk(*paths, cache=dircache, workers=scan_workers,
+                                tmpdir=tmpdir)
+
+    digest = hashcache.digest if hashcache else dirindex.file_digest
+
+    for change, rec in dirindex.iterdiff(dirindex.iterload(di_path, tmpdir), current,
+                                             paths, digest):
+        if change in ('new', 'edited'):
+            yield Change.Overwrite(rec.path, rec.uid, rec.gid, rec.size)
+        elif change == 'stat':
+            yield Change.Stat(rec.path, rec.uid, rec.gid, rec.mod)
+        elif change == 'deleted':
+            yield Change.Deleted(rec.path)
+
+def iterolist(changes, di_path, paths, tmpdir=None):
+    """Yields paths to overwrite for changes (from iterchanges, in path
+       order) in path order, where a new directory replaces the paths
+       beneath it if everything beneath it is new.
+
+       A directory is new if it isn't in the saved dirindex and nothing
+       beneath it is. It isn't collapsed if paths exclude anything beneath
+       it, because the whole directory would be included.
+
+       Changes are merged with the saved dirindex in a single pass, so
+       memory use doesn't grow with the number of changes. Only paths that
+       come between a new directory and its contents (e.g., /a-b/x between
+       /a and /a/x) are held back until we know whether it is collapsed."""
+
+    pathmap = PathMap(paths)
 
-    di_saved = DirIndex(di_path)
-    di_fs = DirIndex()
-    di_fs.walk(*paths)
+    saved = ( rec.path for rec in dirindex.iterload(di_path, tmpdir) )
+    head = [ next(saved, None) ]
 
-    new, edited, statfix = di_saved.diff(di_fs)
-    changes = Changes()
+    def seek(key):
+        """return first saved path >= key. Keys never go backwards"""
+        while head[0] is not None and head[0] < key:
+            head[0] = next(saved, None)
 
-    changes += [ Change.Overwrite(path) for path in new + edited ]
-    changes += [ Change.Stat(path) for path in statfix ]
+        return head[0]
 
-    di_saved.prune(*paths)
-    deleted = set(di_saved) - set(di_fs)
-    changes += [ Change.Deleted(path) for path in deleted ]
+    # new directories whose subtrees we haven't passed, innermost last (in
+    # path order a subtree ends before the subtrees of the directories
+    # around it). Each is [ path, collapsed, yielded ] where collapsed is
+    # None until we enter its subtree
+    newdirs = []
+
+    # paths that may sort after a new directory we may yet yield
+    held = []
+    prev = None
+
+    for change in changes:
+        path = change.path
+
+        while newdirs and path > newdirs[-1][0] + '/' and \
+              not path.startswith(newdirs[-1][0] + '/'):
+            newdirs.pop()
+
+        top = None
+        for newdir in newdirs:
+            dir = newdir[0]
+            if not path.startswith(dir + '/'):
+                continue
+
+            if newdir[1] is None:
+                first = seek(dir + '/')
+                newdir[1] = not (first and first.startswith(dir + '/'))
+
+            if newdir[1] and top is None:
+                top = newdir
+
+        if change.OP == 's' and stat.S_ISDIR(change.mode):
+            if seek(path) != path and not pathmap.excluded_beneath(path):
+                newdirs.append([ path, None, False ])
+
+        if change.OP == 'o':
+            if top:
+                path = top[0]
+                top[2] = True
+
+            if path != prev:
+                held.append(path)
+            prev = path
+
+        if not held:
+            continue
+
+        for dir, collapsed, yielded in newdirs:
+            if collapsed is None or (collapsed and not yielded):
+                break
+        else:
+            held.sort()
+            for path in held:
+                yield path
+            held = []
+
+    held.sort()
+    for path in held:
+        yield path
+
+def whatchanged(di_path, paths, scan_workers=DirIndex.SCAN_WORKERS, dircache=None,
+                hashcache=None):
+    """Compared current filesystem with a saved dirindex from before.
+       Returns a Changes() list."""
 
-    return changes
+    return Changes(iterchanges(di_path, paths, scan_workers, dircache, hashcache))
 
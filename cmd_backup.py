@@ -64,6 +64,17 @@ Configurable options:
     --s3-parallel-uploads=N        Number of parallel volume chunk uploads
                                    default: $CONF_S3_PARALLEL_UPLOADS
 
+    --scan-workers=N               Number of threads scanning the filesystem for changes
+                                   default: $CONF_SCAN_WORKERS
+
+    --mysql-dump-workers=N         Number of connections dumping MySQL tables
+                                   default: $CONF_MYSQL_DUMP_WORKERS
+
+    --mysql-incremental            Reuse rows of MySQL tables unchanged since the last backup
+
+    --mysql-rows-tsv               Save MySQL rows as tab separated values, which
+                                   restore with LOAD DATA (faster than INSERT)
+
     --full-backup FREQUENCY        Time frequency of full backup
                                    default: $CONF_FULL_BACKUP
 
@@ -168,6 +179,8 @@ def usage(e=None):
                                     CONF_VOLSIZE=conf.volsize,
                                     CONF_FULL_BACKUP=conf.full_backup,
                                     CONF_S3_PARALLEL_UPLOADS=conf.s3_parallel_uploads,
+                                    CONF_SCAN_WORKERS=conf.scan_workers,
+                                    CONF_MYSQL_DUMP_WORKERS=conf.mysql_dump_workers,
                                     LOGFILE=PATH_LOGFILE)
     sys.exit(1)
 
@@ -201,7 +214,9 @@ def main():
                                         'logfile=',
                                         'simulate', 'quiet',
                                         'force-profile=', 'secretfile=', 'address=',
-                                        'volsize=', 's3-parallel-uploads=', 'full-backup='])
+                                        'volsize=', 's3-parallel-uploads=', 'scan-workers=',
+                                        'mysql-dump-workers=', 'mysql-incremental', 'mysql-rows-tsv',
+                                        'full-backup='])
     except getopt.GetoptError, e:
         usage(e)
 
@@ -269,6 +284,18 @@ def main():
         elif opt == '--s3-parallel-uploads':
             conf.s3_parallel_uploads = val
 
+        elif opt == '--scan-workers':
+            conf.scan_workers = val
+
+        elif opt == '--mysql-dump-workers':
+            conf.mysql_dump_workers = val
+
+        elif opt == '--mysql-incremental':
+            conf.mysql_incremental = True
+
+        elif opt == '--mysql-rows-tsv':
+            conf.mysql_rows_tsv = True
+
         elif opt == '--full-backup':
             conf.full_backup = val
 
@@ -440,7 +467,11 @@ def main():
             b = backup.Backup(registry.profile,
                               conf.overrides,
                               conf.backup_skip_files, conf.backup_skip_packages, conf.backup_skip_database,
-                              opt_resume, True, dump_path if dump_path else "/")
+                              opt_resume, True, dump_path if dump_path else "/",
+                              conf.scan_workers, registry.path.dircache, registry.path.hashcache,
+                              conf.mysql_dump_workers,
+                              registry.path.mysqlcache if conf.mysql_incremental else None,
+                              conf.mysql_rows_tsv)
 
             hooks.backup.inspect(b.extras_paths.path)
 
@@ -450,14 +481,13 @@ def main():
                 print "\n" + fmt_title("Executing Duplicity to backup system changes to encrypted, incremental archives")
                 _print("export PASSPHRASE=$(cat %s)" % conf.secretfile)
 
+                filelist = b.filelist()
                 uploader = duplicity.Uploader(True,
                                               conf.volsize,
                                               conf.full_backup,
                                               conf.s3_parallel_uploads,
                                               includes=[ b.extras_paths.path ],
-                                              include_filelist=b.extras_paths.fsdelta_olist
-                                                               if exists(b.extras_paths.fsdelta_olist)
-                                                               else None,
+                                              include_filelist=filelist.path if filelist else None,
                                               excludes=[ '**' ])
 
                 uploader('/', target, force_cleanup=not b.resume, dry_run=opt_simulate, debug=opt_debug,
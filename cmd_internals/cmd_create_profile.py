@@ -71,6 +71,12 @@ Options:
                     profile was generated so the backup will include everything wholesale.
                     (e.g., all files in /etc vs only files in /etc that have changed)
 
+    --checksum      Include checksums of file contents in the index.
+
+                    Files that have been rewritten with the same contents
+                    (e.g., by a package upgrade) won't be backed up. Only
+                    files that look changed are checksummed at backup time.
+
     --root=PATH     Use this as the root path, instead of /
                     This is useful for generating backup profiles for chroot filesystems
 
@@ -116,13 +122,13 @@ def fatal(e):
 class ProfileGenerator:
 
     @staticmethod
-    def _get_dirindex(path_dirindex_conf, path_rootfs):
+    def _get_dirindex(path_dirindex_conf, path_rootfs, checksum=False):
         paths = dirindex.read_paths(file(path_dirindex_conf))
         paths = [ re.sub(r'^(-?)', '\\1' + path_rootfs, path) 
                   for path in paths ]
 
         tmp = TempFile()
-        dirindex.create(tmp.path, paths)
+        dirindex.create(tmp.path, paths, checksum=checksum)
 
         filtered = [ re.sub(r'^' + path_rootfs, '', line) 
                             for line in file(tmp.path).readlines() ]
@@ -156,7 +162,8 @@ class ProfileGenerator:
         packages.sort()
         return packages
 
-    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True):
+    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True,
+                 checksum=False):
 
         paths = ProfilePaths(path_output)
 
@@ -165,7 +172,7 @@ class ProfileGenerator:
                                              if conf_paths else "")
 
         if dirindex:
-            di = self._get_dirindex(paths.dirindex_conf, rootfs)
+            di = self._get_dirindex(paths.dirindex_conf, rootfs, checksum)
             file(paths.dirindex, "w").write(di)
 
         if packages:
@@ -199,12 +206,14 @@ def main():
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'fh', ['force', 'help', 
                                                             'root=',
                                                             'no-dirindex', 
+                                                            'checksum',
                                                             'no-packages'])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_force = False
     opt_dirindex = True
+    opt_checksum = False
     opt_packages = True
     opt_root = "/"
 
@@ -218,6 +227,9 @@ def main():
         if opt == '--no-dirindex':
             opt_dirindex = False
 
+        if opt == '--checksum':
+            opt_checksum = True
+
         if opt == "--no-packages":
             opt_packages = False
 
@@ -247,7 +259,8 @@ def main():
     except Error, e:
         fatal(e)
 
-    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex)
+    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex,
+                               checksum=opt_checksum)
 
     title = "Custom profile written to %s" % profile.paths.path
     print title
@@ -15,6 +15,8 @@ Delete files according to delta
 Options:
     -v --verbose               Print list of fixes
     -s --simulate              Print list of fixes, don't apply them
+
+    -w --workers=N             Number of threads deleting files in parallel
 """
 
 import os
@@ -22,7 +24,7 @@ from os.path import *
 
 import sys
 import getopt
-from changes import Changes
+from changes import ChangesFile, apply_actions, APPLY_WORKERS
 
 def usage(e=None):
     if e:
@@ -34,18 +36,24 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'svh', 
-                                       ['simulate', 'verbose'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'w:svh', 
+                                       ['workers=', 'simulate', 'verbose'])
     except getopt.GetoptError, e:
         usage(e)
 
     simulate = False
     verbose = False
+    workers = APPLY_WORKERS
     for opt, val in opts:
         if opt in ('-s', '--simulate'):
             simulate = True
         elif opt in ('-v', '--verbose'):
             verbose = True
+        elif opt in ('-w', '--workers'):
+            try:
+                workers = int(val)
+            except ValueError:
+                usage("workers not a number (%s)" % val)
         else:
             usage()
 
@@ -55,16 +63,19 @@ def main():
     delta = args[0]
     paths = args[1:]
 
-    changes = Changes.fromfile(delta, paths)
+    changes = ChangesFile(delta, paths)
     if simulate:
         verbose = True
 
-    for action in changes.deleted():
-        if verbose:
-            print action
+    def log(action):
+        print action
 
-        if not simulate:
-            action()
+    actions = changes.deleted()
+    if simulate:
+        for action in actions:
+            log(action)
+    else:
+        apply_actions(actions, workers, log if verbose else None)
 
 if __name__=="__main__":
     main()
@@ -16,6 +16,10 @@ Options:
     -i --input=PATH     Read a list of paths from a file (- for stdin)
 
     -c --create         Create index
+    -b --binary         Create index in binary format (default: text)
+    --checksum          Create index with content digests of regular files
+
+    -w --workers=N      Number of threads scanning directories in parallel
 """
 import sys
 import getopt
@@ -33,13 +37,16 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:ch', 
-                                       ['create', 'input='])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:w:cbh', 
+                                       ['create', 'binary', 'checksum', 'input=', 'workers='])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_create = False
+    opt_binary = False
+    opt_checksum = False
     opt_input = None
+    opt_workers = dirindex.DirIndex.SCAN_WORKERS
 
     for opt, val in opts:
         if opt in ('-h', '--help'):
@@ -48,9 +55,21 @@ def main():
         elif opt in ('-c', '--create'):
             opt_create = True
 
+        elif opt in ('-b', '--binary'):
+            opt_binary = True
+
+        elif opt == '--checksum':
+            opt_checksum = True
+
         elif opt in ('-i', '--input'):
             opt_input = val
 
+        elif opt in ('-w', '--workers'):
+            try:
+                opt_workers = int(val)
+            except ValueError:
+                usage("workers not a number (%s)" % val)
+
     if not args or (not opt_input and len(args) < 2):
         usage()
 
@@ -62,10 +81,10 @@ def main():
         paths = dirindex.read_paths(fh) + paths
 
     if opt_create:
-        dirindex.create(path_index, paths)
+        dirindex.create(path_index, paths, opt_workers, opt_binary, opt_checksum)
         return
 
-    for change in changes.whatchanged(path_index, paths):
+    for change in changes.whatchanged(path_index, paths, opt_workers):
         print change
 
 if __name__=="__main__":
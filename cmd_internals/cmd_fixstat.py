@@ -18,6 +18,8 @@ Options:
 
     -v --verbose               Print list of fixes
     -s --simulate              Print list of fixes, don't apply them
+
+    -w --workers=N             Number of threads applying fixes in parallel
     
     <mapspec> := <key>,<val>[:<key>,<val> ...]
 """
@@ -26,7 +28,7 @@ import os
 import sys
 import getopt
 
-from changes import Changes
+from changes import ChangesFile, apply_actions, APPLY_WORKERS
 
 def usage(e=None):
     if e:
@@ -38,13 +40,14 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:g:svh', 
-                                       ['uid-map=', 'gid-map=', 'simulate', 'verbose'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:g:w:svh', 
+                                       ['uid-map=', 'gid-map=', 'workers=', 'simulate', 'verbose'])
     except getopt.GetoptError, e:
         usage(e)
 
     verbose = False
     simulate = False
+    workers = APPLY_WORKERS
 
     uidmap = {}
     gidmap = {}
@@ -61,6 +64,11 @@ def main():
             simulate = True
         elif opt in ('-v', '--verbose'):
             verbose = True
+        elif opt in ('-w', '--workers'):
+            try:
+                workers = int(val)
+            except ValueError:
+                usage("workers not a number (%s)" % val)
         else:
             usage()
 
@@ -70,16 +78,19 @@ def main():
     delta = args[0]
     paths = args[1:]
 
-    changes = Changes.fromfile(delta, paths)
+    changes = ChangesFile(delta, paths)
     if simulate:
         verbose = True
 
-    for action in changes.statfixes(uidmap, gidmap):
-        if verbose:
-            print action
+    def log(action):
+        print action
 
-        if not simulate:
-            action()
+    actions = changes.statfixes(uidmap, gidmap)
+    if simulate:
+        for action in actions:
+            log(action)
+    else:
+        apply_actions(actions, workers, log if verbose else None)
 
 if __name__=="__main__":
     main()
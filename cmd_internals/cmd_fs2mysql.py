@@ -19,6 +19,12 @@ Options:
     --skip-extended-insert  Skip extended insert (useful in debugging)
     --add-drop-database     Drop databases and then recreate them
 
+    -w --workers=N          Restore tables with N parallel connections
+                            (incompatible with --tofile)
+
+    --load-data             LOAD DATA LOCAL INFILE rows saved as tab separated values
+                            (otherwise they're converted to INSERT statements)
+
 Supports the following subset of mysql(1) options:
 
     -u --user=USER 
@@ -43,8 +49,8 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:p:v', 
-                                       ['verbose', 'tofile=',
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:p:vw:', 
+                                       ['verbose', 'tofile=', 'workers=', 'load-data',
                                         'skip-extended-insert',
                                         'add-drop-database',
                                         'user=', 'password=', 'defaults-file=', 'host='])
@@ -55,6 +61,8 @@ def main():
     opt_tofile = None
     opt_skip_extended_insert = False
     opt_add_drop_database = False
+    opt_workers = mysql.RESTORE_WORKERS
+    opt_load_data = False
     myconf = {}
     for opt, val in opts:
         if opt in ('-v', '--verbose'):
@@ -65,6 +73,16 @@ def main():
             opt_skip_extended_insert = True
         elif opt == '--add-drop-database':
             opt_add_drop_database = True
+        elif opt == '--load-data':
+            opt_load_data = True
+        elif opt in ('-w', '--workers'):
+            try:
+                opt_workers = int(val)
+            except ValueError:
+                usage("--workers not a number (%s)" % val)
+
+            if opt_workers < 1:
+                usage("--workers must be at least 1")
         elif opt in ('-u', '--user'):
             myconf['user'] = val
         elif opt in ('-p', '--password'):
@@ -82,6 +100,21 @@ def main():
     myfs = args[0]
     limits = args[1:]
 
+    if opt_load_data and not opt_tofile:
+        myconf['local_infile'] = "1"
+
+    if opt_workers > 1:
+        if opt_tofile:
+            usage("--tofile incompatible with --workers")
+
+        callback = mysql.cb_print() if opt_verbose else None
+        mysql.fs2mysql_parallel(lambda: mysql.mysql(**myconf), myfs, limits, callback,
+                                opt_skip_extended_insert,
+                                opt_add_drop_database,
+                                opt_workers,
+                                opt_load_data)
+        return
+
     if opt_tofile:
         if opt_tofile == '-':
             fh = sys.stdout
@@ -100,7 +133,8 @@ def main():
 
     mysql.fs2mysql(fh, myfs, limits, callback, 
                    opt_skip_extended_insert,
-                   opt_add_drop_database)
+                   opt_add_drop_database,
+                   opt_load_data)
 
 if __name__ == "__main__":
     main()
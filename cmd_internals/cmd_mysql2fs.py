@@ -17,6 +17,11 @@ Options:
     --fromfile=PATH         Read mysqldump output from file (- for STDIN)
                             Requires: --all-databases --skip-extended-insert
 
+    -w --workers=N          Dump tables with N parallel connections
+                            (InnoDB tables from one snapshot)
+
+    --tsv                   Save rows as tab separated values (LOAD DATA lines)
+
     -v --verbose            Turn on verbosity
 
 Supports the following subset of mysqldump(1) options:
@@ -52,8 +57,8 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'Du:p:v', 
-                                       ['verbose', 'delete', 'fromfile=',
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'Du:p:vw:', 
+                                       ['verbose', 'delete', 'fromfile=', 'workers=', 'tsv',
                                         'user=', 'password=', 'defaults-file=', 'host='])
     except getopt.GetoptError, e:
         usage(e)
@@ -61,6 +66,8 @@ def main():
     opt_verbose = False
     opt_fromfile = None
     opt_delete = False
+    opt_workers = mysql.DUMP_WORKERS
+    opt_tsv = False
     myconf = {}
     for opt, val in opts:
         if opt in ('-v', '--verbose'):
@@ -69,6 +76,16 @@ def main():
             opt_fromfile = val
         elif opt in ('-D', "--delete"):
             opt_delete = True
+        elif opt == '--tsv':
+            opt_tsv = True
+        elif opt in ('-w', '--workers'):
+            try:
+                opt_workers = int(val)
+            except ValueError:
+                usage("--workers not a number (%s)" % val)
+
+            if opt_workers < 1:
+                usage("--workers must be at least 1")
         elif opt in ('-u', '--user'):
             myconf['user'] = val
         elif opt in ('-p', '--password'):
@@ -89,12 +106,20 @@ def main():
     if opt_fromfile and myconf:
         fatal("--fromfile incompatible with mysqldump options")
 
+    if opt_fromfile and opt_workers > 1:
+        fatal("--fromfile incompatible with --workers")
+
     if opt_delete and isdir(outdir):
         shutil.rmtree(outdir)
 
     if not exists(outdir):
         os.mkdir(outdir)
 
+    if opt_workers > 1:
+        callback = mysql.cb_print() if opt_verbose else None
+        mysql.mysql2fs_parallel(outdir, limits, callback, opt_workers, tsv=opt_tsv, **myconf)
+        return
+
     if opt_fromfile:
         if opt_fromfile == '-':
             mysqldump_fh = sys.stdin
@@ -108,7 +133,7 @@ def main():
         print "source: " + mysqldump_fh.name
         callback = mysql.cb_print()
 
-    mysql.mysql2fs(mysqldump_fh, outdir, limits, callback)
+    mysql.mysql2fs(mysqldump_fh, outdir, limits, callback, opt_tsv)
 
 if __name__ == "__main__":
     main()
@@ -95,6 +95,13 @@ Options / Configurable (see resolution order below):
     --restore-cache-dir=PATH          The path to the download cache directory
                                       default: $CONF_RESTORE_CACHE_DIR
 
+    --mysql-restore-workers=N         Number of connections restoring MySQL tables
+                                      default: $CONF_MYSQL_RESTORE_WORKERS
+
+    --apply-workers=N                 Number of threads fixing file ownership and
+                                      permissions in parallel
+                                      default: $CONF_APPLY_WORKERS
+
 Resolution order for configurable options:
 
   1) command line (highest precedence)
@@ -278,7 +285,9 @@ def usage(e=None):
     conf = Conf()
     print >> stdout, tpl.substitute(CONF_PATH=conf.paths.conf,
                                     CONF_RESTORE_CACHE_SIZE=conf.restore_cache_size,
-                                    CONF_RESTORE_CACHE_DIR=conf.restore_cache_dir)
+                                    CONF_RESTORE_CACHE_DIR=conf.restore_cache_dir,
+                                    CONF_MYSQL_RESTORE_WORKERS=conf.mysql_restore_workers,
+                                    CONF_APPLY_WORKERS=conf.apply_workers)
 
     sys.exit(1)
 
@@ -311,6 +320,7 @@ def main():
                                         'limits=', 'address=', 'keyfile=',
                                         'logfile=',
                                         'restore-cache-size=', 'restore-cache-dir=',
+                                        'mysql-restore-workers=', 'apply-workers=',
                                         'force',
                                         'time=',
                                         'silent',
@@ -380,6 +390,12 @@ def main():
         elif opt == '--restore-cache-dir':
             conf.restore_cache_dir = val
 
+        elif opt == '--mysql-restore-workers':
+            conf.mysql_restore_workers = val
+
+        elif opt == '--apply-workers':
+            conf.apply_workers = val
+
         elif opt == '--debug':
             opt_debug = True
 
@@ -501,7 +517,9 @@ def main():
         if not silent:
             print fmt_title("Restoring system from backup extract at " + backup_extract_path)
 
-        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate)
+        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate,
+                          mysql_restore_workers=conf.mysql_restore_workers,
+                          apply_workers=conf.apply_workers)
 
         if restore.conf:
             os.environ['TKLBAM_RESTORE_PROFILE_ID'] = restore.conf.profile_id
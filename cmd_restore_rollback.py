@@ -12,15 +12,21 @@
 """
 Rollback last restore
 
+An interrupted or failed rollback resumes where it left off.
+
 Options:
 
-    --force     Don't ask for confirmation (caution)
+    --force             Don't ask for confirmation (caution)
+    -w --workers=N      Number of threads rolling back files in parallel
 """
 
 import sys
 import getopt
 
+from os.path import exists
+
 from rollback import Rollback
+from changes import APPLY_WORKERS
 
 def fatal(e):
     print >> sys.stderr, "error: " + str(e)
@@ -36,17 +42,23 @@ def usage(e=None):
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
-                                       ['force', 'help'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'w:h',
+                                       ['force', 'workers=', 'help'])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_force = False
+    opt_workers = APPLY_WORKERS
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
         if opt == '--force':
             opt_force = True
+        if opt in ('-w', '--workers'):
+            try:
+                opt_workers = int(val)
+            except ValueError:
+                usage("workers not a number (%s)" % val)
 
     if args:
         usage()
@@ -59,6 +71,8 @@ def main():
     if not opt_force:
         print "DATA LOSS WARNING: this will rollback your system to the pre-restore"
         print "snapshot from " + rollback.timestamp.ctime()
+        if exists(rollback.paths.journal):
+            print "(resuming an interrupted rollback)"
         print
 
         while True:
@@ -70,7 +84,10 @@ def main():
             print "You didn't answer 'yes'. Aborting!"
             sys.exit(1)
 
-    rollback.rollback()
+    try:
+        rollback.rollback(opt_workers)
+    except Rollback.Error, e:
+        fatal(e)
 
 if __name__=="__main__":
     main()
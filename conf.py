@@ -119,13 +119,32 @@ class Conf(AttrDict):
             except ValueError:
                 raise self.Error("s3-parallel-uploads not a number (%s)" % val)
 
+        if name == 'scan_workers':
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("scan-workers not a number (%s)" % val)
+
+            if val < 1:
+                raise self.Error("scan-workers must be at least 1 (%d)" % val)
+
+        if name in ('mysql_dump_workers', 'mysql_restore_workers', 'apply_workers'):
+            opt = name.replace('_', '-')
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("%s not a number (%s)" % (opt, val))
+
+            if val < 1:
+                raise self.Error("%s must be at least 1 (%d)" % (opt, val))
+
         if name == 'restore_cache_size':
             if not re.match(r'^\d+(%|mb?|gb?)?$', val, re.IGNORECASE):
                 raise self.Error("bad restore-cache value (%s)" % val)
 
         backup_skip_options = [ 'backup_skip_' + opt
                                 for opt in ('files', 'database', 'packages') ]
-        if name in backup_skip_options:
+        if name in backup_skip_options + [ 'mysql_incremental', 'mysql_rows_tsv' ]:
             if val not in (True, False):
                 if re.match(r'^true|1|yes$', val, re.IGNORECASE):
                     val = True
@@ -134,7 +153,7 @@ class Conf(AttrDict):
                 else:
                     raise self.Error("bad bool value '%s'" % val)
 
-            if val:
+            if val and name in backup_skip_options:
                 os.environ['TKLBAM_' + name.upper()] = 'yes'
 
         AttrDict.__setitem__(self, name, val)
@@ -152,12 +171,24 @@ class Conf(AttrDict):
         self.force_profile = None
         self.overrides = Limits.fromfile(self.paths.overrides)
 
+        # only needed for their defaults, so importing conf doesn't import them
+        from dirindex import DirIndex
+        from changes import APPLY_WORKERS
+        import mysql
+
         self.volsize = duplicity.Uploader.VOLSIZE
         self.s3_parallel_uploads = duplicity.Uploader.S3_PARALLEL_UPLOADS
         self.full_backup = duplicity.Uploader.FULL_IF_OLDER_THAN
 
+        self.scan_workers = DirIndex.SCAN_WORKERS
+        self.mysql_dump_workers = mysql.DUMP_WORKERS
+        self.mysql_incremental = False
+        self.mysql_rows_tsv = False
+
         self.restore_cache_size = duplicity.Downloader.CACHE_SIZE
         self.restore_cache_dir = duplicity.Downloader.CACHE_DIR
+        self.mysql_restore_workers = mysql.RESTORE_WORKERS
+        self.apply_workers = APPLY_WORKERS
 
         self.backup_skip_files = False
         self.backup_skip_database = False
@@ -177,8 +208,9 @@ class Conf(AttrDict):
                 raise self._error("illegal line '%s'" % (line))
 
             try:
-                if opt in ('full-backup', 'volsize', 's3-parallel-uploads',
-                           'restore-cache-size', 'restore-cache-dir',
+                if opt in ('full-backup', 'volsize', 's3-parallel-uploads', 'scan-workers',
+                           'mysql-dump-workers', 'mysql-incremental', 'mysql-rows-tsv', 'restore-cache-size', 'restore-cache-dir',
+                           'mysql-restore-workers', 'apply-workers',
                            'backup-skip-files', 'backup-skip-packages', 'backup-skip-database', 'force-profile'):
 
                     attrname = opt.replace('-', '_')
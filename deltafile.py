@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""Packed path list files (e.g., fsdelta, fsdelta-olist)
+
+A packed file is gzip compressed text that starts with a header line
+(magic and version). Each following line is a tab separated record whose
+path field only stores what's left after the prefix it shares with the
+previous path, and starts with the (hex) length of the shared prefix:
+
+    0   o   /etc/hostname   0   0
+    5   o   hosts           0   0
+
+Readers accept both packed files and plain text files, one record per line.
+"""
+import sys
+import zlib
+import itertools
+from os.path import commonprefix
+
+MAGIC = "#tklbam-delta"
+VERSION = 1
+
+GZIP_MAGIC = "\x1f\x8b"
+BLOCKSIZE = 65536
+
+class Error(Exception):
+    pass
+
+def write(path, lines, column=0):
+    """write lines to path in packed format, where column is the index of
+    the path field. Lines should be sorted by path for best compression"""
+
+    fh = file(path, "wb")
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    buf = ["%s %d\n" % (MAGIC, VERSION)]
+    prev = ""
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+
+        path = fields[column]
+        shared = len(commonprefix((prev, path)))
+        fields[column] = path[shared:]
+        prev = path
+
+        buf.append("%x\t%s\n" % (shared, "\t".join(fields)))
+        if len(buf) > 1024:
+            fh.write(compressor.compress("".join(buf)))
+            buf = []
+
+    fh.write(compressor.compress("".join(buf)))
+    fh.write(compressor.flush())
+    fh.close()
+
+def _chunks(fh):
+    while True:
+        buf = fh.read(BLOCKSIZE)
+        if not buf:
+            return
+        yield buf
+
+def _decompress(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for buf in chunks:
+        yield decompressor.decompress(buf)
+    yield decompressor.flush()
+
+def _lines(chunks):
+    partial = ""
+    for buf in chunks:
+        lines = (partial + buf).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line + "\n"
+
+    if partial:
+        yield partial
+
+def _unpack(lines, column):
+    try:
+        header = lines.next()
+    except StopIteration:
+        raise Error("packed file is missing header")
+
+    vals = header.split()
+    if len(vals) != 2 or vals[0] != MAGIC:
+        raise Error("bad packed file header: " + `header`)
+
+    if int(vals[1]) != VERSION:
+        raise Error("unsupported packed file version " + vals[1])
+
+    prev = ""
+    for line in lines:
+        shared, line = line.rstrip("\n").split("\t", 1)
+        fields = line.split("\t")
+
+        path = prev[:int(shared, 16)] + fields[column]
+        fields[column] = path
+        prev = path
+
+        yield "\t".join(fields) + "\n"
+
+def iterlines(path, column=0):
+    """yield lines of a packed or plain text file ('-' for stdin) lazily,
+    where column is the index of the path field"""
+
+    fh = sys.stdin if path == '-' else file(path, "rb")
+
+    head = fh.read(len(GZIP_MAGIC))
+    chunks = itertools.chain([ head ], _chunks(fh))
+
+    if head != GZIP_MAGIC:
+        return _lines(chunks)
+
+    return _unpack(_lines(_decompress(chunks)), column)
@@ -10,18 +10,273 @@
 #
 import re
 import os
+import sys
 import stat
 from os.path import *
 
+import time
+import mmap
+import heapq
+import hashlib
+import struct
+import marshal
+import threading
+from Queue import Queue
+
+import extsort
 from pathmap import PathMap
 
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 class Error(Exception):
     pass
 
+def _lstat_entries(dir, skip=None, names=None):
+    """yield (path, lstat) for every entry in dir, unless skip(path).
+    If names is provided we don't need to read the directory.
+
+    Each entry costs a single lstat(2), skipped entries cost nothing"""
+
+    if names is not None:
+        for name in names:
+            path = join(dir, name)
+            if skip and skip(path):
+                continue
+
+            yield path, os.lstat(path)
+
+    elif scandir:
+        for entry in scandir(dir):
+            if skip and skip(entry.path):
+                continue
+
+            yield entry.path, entry.stat(follow_symlinks=False)
+    else:
+        for dentry in os.listdir(dir):
+            path = join(dir, dentry)
+            if skip and skip(path):
+                continue
+
+            yield path, os.lstat(path)
+
+def _roots(pathmap):
+    """yield (path, lstat) for the includes in pathmap that need walking.
+
+    Includes that walking another include already reaches (e.g., /var/www
+    when /var is included) are skipped so they aren't walked twice"""
+
+    def reached(path, roots):
+        if pathmap.is_pruned(path):
+            return False
+
+        # parents between path and the nearest root above it
+        parents = []
+        parent = dirname(path)
+        while parent not in roots:
+            if parent == dirname(parent):
+                return False
+
+            parents.append(parent)
+            parent = dirname(parent)
+
+        for parent in parents:
+            if pathmap.is_pruned(parent):
+                return False
+
+            # walks don't follow symlinks
+            try:
+                if not stat.S_ISDIR(os.lstat(parent).st_mode):
+                    return False
+            except OSError:
+                return False
+
+        return True
+
+    roots = set()
+    for path in sorted(pathmap.includes):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+
+        if reached(path, roots):
+            continue
+
+        roots.add(path)
+        yield path, st
+
+def _walk_parallel(dirs, skip, workers, Record):
+    """walk dirs using a pool of worker threads that share a queue of
+    directories. Yields Records for everything under dirs, in no particular
+    order.
+
+    Scanning is latency bound (lstat releases the GIL) so threads let us
+    keep more requests in flight than a serial walk."""
+
+    queue = Queue()
+    results = Queue()
+
+    # directories queued but not scanned yet
+    pending = [ len(dirs) ]
+    lock = threading.Lock()
+    stopped = []
+
+    def worker():
+        while True:
+            dir = queue.get()
+            if dir is None or stopped:
+                return
+
+            try:
+                recs = [ Record.fromstat(path, st)
+                         for path, st in _lstat_entries(dir, skip) ]
+                subdirs = [ rec.path for rec in recs if stat.S_ISDIR(rec.mod) ]
+
+                # results go first so the last directory's None comes last
+                results.put(recs)
+
+                lock.acquire()
+                pending[0] += len(subdirs) - 1
+                done = pending[0] == 0
+                lock.release()
+
+                for subdir in subdirs:
+                    queue.put(subdir)
+
+                if done:
+                    results.put(None)
+            except:
+                results.put(sys.exc_info())
+
+    if not dirs:
+        return
+
+    for dir in dirs:
+        queue.put(dir)
+
+    threads = [ threading.Thread(target=worker) for i in range(workers) ]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+
+            if isinstance(result, tuple):
+                exc_type, exc_value, exc_tb = result
+                raise exc_type, exc_value, exc_tb
+
+            for rec in result:
+                yield rec
+    finally:
+        # workers that are still busy (e.g., after an error) finish their
+        # current directory and then stop
+        stopped.append(True)
+        for thread in threads:
+            queue.put(None)
+
+def _walk_sorted(rec, st, skip, Record, cache=None):
+    """yield rec and (if it's a directory) every record beneath it in sorted
+    path order. Memory is bounded by the size of the directories on the
+    current branch of the walk"""
+
+    def lstat_entries(dir, st):
+        if not cache:
+            return _lstat_entries(dir, skip)
+
+        try:
+            return list(_lstat_entries(dir, skip, cache.listdir(dir, st)))
+        except OSError:
+            # a stale listing, fall back to reading the directory
+            cache.forget(dir)
+            return _lstat_entries(dir, skip)
+
+    def entries(dir, st):
+        # a directory's subtree is keyed by "path/" so that it sorts
+        # exactly where its paths would appear (e.g., "a-b" < "a/x")
+        items = []
+        for path, st in lstat_entries(dir, st):
+            items.append((path, Record.fromstat(path, st), None))
+            if stat.S_ISDIR(st.st_mode):
+                items.append((path + '/', None, st))
+
+        items.sort()
+        return iter(items)
+
+    yield rec
+    if not stat.S_ISDIR(st.st_mode):
+        return
+
+    stack = [ entries(rec.path, st) ]
+    while stack:
+        try:
+            key, rec, st = stack[-1].next()
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if rec is None:
+            stack.append(entries(key[:-1], st))
+        else:
+            yield rec
+
+def _cmp_new(b):
+    """classify a record that isn't in the saved index"""
+
+    # ignore Unix sockets
+    if stat.S_ISSOCK(b.mod):
+        return None
+
+    if stat.S_ISDIR(b.mod):
+        return 'stat'
+
+    return 'new'
+
+def _same_content(a, b, digest):
+    """True if saved record a has a digest that matches current file b"""
+
+    if not (digest and a.digest) or a.size != b.size or not stat.S_ISREG(b.mod):
+        return False
+
+    try:
+        return digest(b.path) == a.digest
+    except (IOError, OSError):
+        return False
+
+def _cmp_records(a, b, digest=None):
+    """classify the difference between saved record a and current record b
+
+    If a has a content digest, digest(path) is used to check whether a file
+    that looks edited was just rewritten with the same content"""
+
+    if a.size != b.size or a.mtime != b.mtime:
+        symlink_equal = a.symlink and (a.symlink == b.symlink)
+        if not (stat.S_ISDIR(b.mod) or stat.S_ISSOCK(b.mod)) \
+           and not symlink_equal and not _same_content(a, b, digest):
+            return 'edited'
+
+    if a.mod != b.mod or a.uid != b.uid or a.gid != b.gid:
+        return 'stat'
+
+    return None
+
 class DirIndex(dict):
-    class Record:
+    SCAN_WORKERS = 1
+
+    class Record(object):
+        # an index may hold millions of records, __slots__ avoids a
+        # per-record __dict__
+        __slots__ = ('path', 'mod', 'uid', 'gid', 'size', 'mtime', 'symlink',
+                     'digest')
+
         def __init__(self, path, mod, uid, gid, size, mtime,
-                     symlink=None):
+                     symlink=None, digest=None):
             self.path = path
             self.mod = mod
             self.uid = uid
@@ -29,11 +284,14 @@ class DirIndex(dict):
             self.size = size
             self.mtime = mtime
             self.symlink = symlink
+            self.digest = digest
 
         @classmethod
         def frompath(cls, path):
-            st = os.lstat(path)
+            return cls.fromstat(path, os.lstat(path))
 
+        @classmethod
+        def fromstat(cls, path, st):
             symlink = os.readlink(path) \
                       if stat.S_ISLNK(st.st_mode) else None
 
@@ -47,7 +305,7 @@ class DirIndex(dict):
         @classmethod
         def fromline(cls, line):
             vals = line.strip().split('\t')
-            if len(vals) not in (6, 7):
+            if len(vals) not in (6, 7, 8):
                 raise Error("bad index record: " + line)
 
             path = vals[0]
@@ -55,6 +313,10 @@ class DirIndex(dict):
 
             vals = [ int(val, 16) for val in vals[:5] ] + vals[5:]
 
+            # records with a digest have a (possibly empty) symlink field
+            if len(vals) == 7:
+                vals[5] = vals[5] or None
+
             return cls(path, *vals)
 
         def fmt(self):
@@ -62,7 +324,9 @@ class DirIndex(dict):
             for val in ( self.mod, self.uid, self.gid, self.size, self.mtime ):
                 vals.append("%x" % val)
 
-            if self.symlink:
+            if self.digest:
+                vals += [ self.symlink or "", self.digest ]
+            elif self.symlink:
                 vals.append(self.symlink)
 
             return "\t".join(vals)
@@ -72,61 +336,93 @@ class DirIndex(dict):
                     (`self.path`, oct(self.mod), self.uid, self.gid, self.size, self.mtime)
 
     @classmethod
-    def create(cls, path_index, paths):
+    def create(cls, path_index, paths, workers=SCAN_WORKERS, binary=False,
+               checksum=False):
         """create index from paths"""
         di = cls()
-        di.walk(*paths)
-        di.save(path_index)
+        di.walk(*paths, workers=workers, checksum=checksum)
+        di.save(path_index, binary)
 
         return di
 
+    @classmethod
+    def load(cls, path):
+        """load saved index for reading. Binary indexes are mmap'ed instead
+        of being read into memory"""
+        if MappedDirIndex.is_binary(path):
+            return MappedDirIndex(path)
+
+        return cls(path)
+
     def __init__(self, fromfile=None):
-        if fromfile:
-            for line in file(fromfile).readlines():
-                if not line.strip():
-                    continue
+        if not fromfile:
+            return
 
-                rec = DirIndex.Record.fromline(line)
+        if MappedDirIndex.is_binary(fromfile):
+            for rec in MappedDirIndex(fromfile).records():
                 self[rec.path] = rec
+            return
+
+        for line in file(fromfile).readlines():
+            if not line.strip():
+                continue
+
+            rec = DirIndex.Record.fromline(line)
+            self[rec.path] = rec
 
     def add_path(self, path):
         """add a single path to the DirIndex"""
         self[path] = DirIndex.Record.frompath(path)
 
-    def walk(self, *paths):
-        """walk paths and add files to index"""
-        pathmap = PathMap(paths)
-
-        def _walk(dir):
-            dentries = []
+    def walk(self, *paths, **kws):
+        """walk paths and add files to index
 
-            for dentry in os.listdir(dir):
-                path = join(dir, dentry)
-                if path in pathmap.excludes:
-                    continue
+        Keyword arguments:
 
-                dentries.append(dentry)
+            workers     number of threads scanning directories in parallel
+            checksum    record content digests of regular files
+        """
+        workers = kws.pop('workers', self.SCAN_WORKERS)
+        checksum = kws.pop('checksum', False)
 
-                if not islink(path) and isdir(path):
-                    for val in _walk(path):
-                        yield val
+        pathmap = PathMap(paths)
+        skip = pathmap.is_pruned
+
+        # walks pass through directories that lead to wildcard matches
+        # (e.g., /home/bob for /home/*/public) without indexing them
+        if pathmap.has_patterns:
+            def add(rec):
+                if rec.path in pathmap:
+                    self[rec.path] = rec
+        else:
+            def add(rec):
+                self[rec.path] = rec
 
-            yield dir, dentries
+        def _walk(dir):
+            for path, st in _lstat_entries(dir, skip):
+                add(self.Record.fromstat(path, st))
 
-        for path in pathmap.includes:
-            if not lexists(path):
-                continue
+                if stat.S_ISDIR(st.st_mode):
+                    _walk(path)
 
-            self.add_path(path)
+        dirs = []
+        for path, st in _roots(pathmap):
+            add(self.Record.fromstat(path, st))
 
-            if islink(path) or not isdir(path):
-                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
 
-            for dpath, dentries in _walk(path):
-                for dentry in dentries:
-                    path = join(dpath, dentry)
+        if workers > 1:
+            for rec in _walk_parallel(dirs, skip, workers, self.Record):
+                add(rec)
+        else:
+            for dir in dirs:
+                _walk(dir)
 
-                    self.add_path(path)
+        if checksum:
+            for rec in self.itervalues():
+                if stat.S_ISREG(rec.mod):
+                    rec.digest = file_digest(rec.path)
 
     def prune(self, *paths):
         """prune index down to paths that are included AND not excluded"""
@@ -136,62 +432,531 @@ class DirIndex(dict):
             if not path in pathmap:
                 del self[path]
 
-    def save(self, tofile):
+    def save(self, tofile, binary=False):
+        if binary:
+            return MappedDirIndex.save(self, tofile)
+
         fh = file(tofile, "w")
         paths = self.keys()
         paths.sort()
         for path in paths:
             print >> fh, self[path].fmt()
 
-    def diff(self, other):
+    def diff(self, other, digest=None):
         a = set(self)
         b = set(other)
 
         files_new = []
+        files_edited = []
         paths_stat = []
 
+        lists = { 'new': files_new,
+                  'edited': files_edited,
+                  'stat': paths_stat }
+
         for path in (b - a):
-            mod = other[path].mod
+            change = _cmp_new(other[path])
+            if change:
+                lists[change].append(path)
 
-            # ignore Unix sockets
-            if stat.S_ISSOCK(mod):
-                continue
+        for path in (b & a):
+            change = _cmp_records(self[path], other[path], digest)
+            if change:
+                lists[change].append(path)
+
+        return files_new, files_edited, paths_stat
+
+class MappedDirIndex:
+    """Read-only DirIndex backed by an mmap'ed binary index file.
+
+    Lookups bisect the file instead of loading it into memory. The file
+    layout (integers in network byte order) is:
+
+        header      magic, version, restart interval, number of records,
+                    number of restarts, offset of restart table
+
+        records     sorted by path, each one storing the length of the
+                    prefix it shares with the previous path, the rest of
+                    the path, fixed width mod, uid, gid, size, mtime, an
+                    optional symlink target and an optional content digest
 
-            if stat.S_ISDIR(mod):
-                paths_stat.append(path)
+        restarts    offsets of every Nth record. Restart records store the
+                    full path (i.e., shared prefix length is 0)
+    """
+    MAGIC = "TKLBAMDI"
+    VERSION = 2
+    RESTART_INTERVAL = 16
+
+    HEADER = struct.Struct("!8sHHIIQ")
+    PATH = struct.Struct("!HH")
+    ATTRS = struct.Struct("!IIIQqHB")
+    OFFSET = struct.Struct("!Q")
+
+    # version 1 records have no digest
+    ATTRS_V1 = struct.Struct("!IIIQqH")
+
+    @classmethod
+    def is_binary(cls, path):
+        fh = file(path, "rb")
+        try:
+            return fh.read(len(cls.MAGIC)) == cls.MAGIC
+        finally:
+            fh.close()
+
+    @classmethod
+    def save(cls, di, tofile):
+        """save DirIndex di to tofile in binary format"""
+
+        fh = file(tofile, "wb")
+        fh.write("\0" * cls.HEADER.size)
+
+        offset = cls.HEADER.size
+        restarts = []
+        prev = ""
+
+        paths = di.keys()
+        paths.sort()
+        for i, path in enumerate(paths):
+            rec = di[path]
+
+            if i % cls.RESTART_INTERVAL == 0:
+                restarts.append(offset)
+                shared = 0
             else:
-                files_new.append(path)
+                shared = len(commonprefix((prev, path)))
 
-        paths_in_both = b & a
-        files_edited = []
-        def attrs_equal(attrs, a, b):
-            for attr in attrs:
-                if getattr(a, attr) != getattr(b, attr):
-                    return False
+            symlink = rec.symlink or ""
+            digest = rec.digest or ""
+            buf = cls.PATH.pack(shared, len(path) - shared) + path[shared:] + \
+                  cls.ATTRS.pack(rec.mod, rec.uid, rec.gid, rec.size, int(rec.mtime),
+                                 len(symlink), len(digest)) + symlink + digest
 
-            return True
+            fh.write(buf)
+            offset += len(buf)
+            prev = path
 
-        def symlink_equal(a, b):
-            if a.symlink and (a.symlink == b.symlink):
-                return True
+        for restart in restarts:
+            fh.write(cls.OFFSET.pack(restart))
 
-            return False
+        fh.seek(0)
+        fh.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.RESTART_INTERVAL,
+                                 len(paths), len(restarts), offset))
+        fh.close()
 
-        for path in paths_in_both:
-            if not attrs_equal(('size', 'mtime'), self[path], other[path]):
-                mod = other[path].mod
-                if not (stat.S_ISDIR(mod) or stat.S_ISSOCK(mod)) \
-                   and not symlink_equal(self[path], other[path]):
-                    files_edited.append(path)
-                    continue
+    def __init__(self, path):
+        fh = file(path, "rb")
+        try:
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
 
-            if not attrs_equal(('mod', 'uid', 'gid'), self[path], other[path]):
-                paths_stat.append(path)
+        magic, version, interval, self.count, self.restarts, self.restarts_offset = \
+                self.HEADER.unpack_from(self.mmap)
 
-        return files_new, files_edited, paths_stat
+        if magic != self.MAGIC:
+            raise Error("not a binary index: " + path)
+
+        if version not in (1, self.VERSION):
+            raise Error("unsupported binary index version %d: %s" % (version, path))
+
+        self.version = version
+
+    def _restart(self, i):
+        offset, = self.OFFSET.unpack_from(self.mmap, self.restarts_offset + i * self.OFFSET.size)
+        return offset
+
+    def _records(self, offset):
+        """yield records sequentially from offset (a restart)"""
+
+        prev = ""
+        end = self.restarts_offset
+
+        PATH = self.PATH
+        ATTRS = self.ATTRS if self.version > 1 else self.ATTRS_V1
+        Record = DirIndex.Record
+
+        while offset < end:
+            shared, unshared = PATH.unpack_from(self.mmap, offset)
+            offset += PATH.size
+
+            path = prev[:shared] + self.mmap[offset:offset + unshared]
+            offset += unshared
+
+            attrs = ATTRS.unpack_from(self.mmap, offset)
+            offset += ATTRS.size
+
+            mod, uid, gid, size, mtime, symlink_len = attrs[:6]
+            digest_len = attrs[6] if len(attrs) > 6 else 0
+
+            symlink = self.mmap[offset:offset + symlink_len] if symlink_len else None
+            offset += symlink_len
+
+            digest = self.mmap[offset:offset + digest_len] if digest_len else None
+            offset += digest_len
+
+            yield Record(path, mod, uid, gid, size, mtime, symlink, digest)
+            prev = path
+
+    def _seek(self, path):
+        """yield records starting from the last restart <= path"""
+
+        lo = 0
+        hi = self.restarts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._restart(mid)
+            shared, unshared = self.PATH.unpack_from(self.mmap, offset)
+            start = offset + self.PATH.size
+            if self.mmap[start:start + unshared] <= path:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return self._records(self.HEADER.size)
+
+        return self._records(self._restart(lo - 1))
+
+    def records(self):
+        """yield all records in path order"""
+        return self._records(self.HEADER.size)
+
+    def iterprefix(self, prefix):
+        """yield records whose path starts with prefix, in path order"""
+        for rec in self._seek(prefix):
+            if rec.path < prefix:
+                continue
+
+            if not rec.path.startswith(prefix):
+                break
+
+            yield rec
+
+    def subtree(self, path):
+        """yield the record for path and every record beneath it"""
+        if path in self:
+            yield self[path]
+
+        for rec in self.iterprefix(path.rstrip('/') + '/'):
+            yield rec
+
+    def get(self, path, default=None):
+        for rec in self._seek(path):
+            if rec.path == path:
+                return rec
+
+            if rec.path > path:
+                break
+
+        return default
+
+    def __getitem__(self, path):
+        rec = self.get(path)
+        if rec is None:
+            raise KeyError(path)
+
+        return rec
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __iter__(self):
+        for rec in self.records():
+            yield rec.path
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return self.count
+
+    diff = DirIndex.diff.im_func
 
 create = DirIndex.create
 
+def file_digest(path):
+    """return hex digest of the contents of path"""
+    h = hashlib.sha1()
+
+    fh = file(path, "rb")
+    try:
+        while True:
+            buf = fh.read(65536)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        fh.close()
+
+    return h.hexdigest()
+
+def iterload(path, tmpdir=None):
+    """yield records of a saved index in path order without loading the
+    whole index into memory. Text indexes saved by older versions aren't
+    sorted, so they are sorted externally (spilling to tmpdir)"""
+
+    if MappedDirIndex.is_binary(path):
+        for rec in MappedDirIndex(path).records():
+            yield rec
+        return
+
+    def records():
+        for line in file(path):
+            if not line.strip():
+                continue
+
+            yield DirIndex.Record.fromline(line)
+
+    prev = None
+    for rec in records():
+        if prev is not None and rec.path < prev:
+            break
+        prev = rec.path
+    else:
+        for rec in records():
+            yield rec
+        return
+
+    Record = DirIndex.Record
+    items = ( tuple([ getattr(rec, attr) for attr in Record.__slots__ ])
+              for rec in records() )
+
+    for item in extsort.iter_sorted(items, tmpdir):
+        yield Record(*item)
+
+class DirCache:
+    """Directory listings saved from a previous walk.
+
+    A directory's listing only changes when an entry is added, removed or
+    renamed, which updates the directory's mtime and ctime. A cached listing
+    is reused as long as the directory's device, inode, mtime and ctime are
+    unchanged, which saves reading the directory again.
+
+    Editing a file in place doesn't change its directory so every entry
+    still needs to be lstat'ed to detect changes.
+    """
+
+    # directories modified this recently may change again without changing
+    # their timestamps (filesystem timestamp granularity), so don't save them
+    RACY_SECONDS = 2
+
+    def __init__(self, path, key=None):
+        """load cache from path, unless it was saved with a different key"""
+        self.path = path
+        self.key = key
+        self.started = time.time()
+
+        self.cached = {}
+        self.listings = {}
+
+        try:
+            saved_key, cached = marshal.load(file(path, "rb"))
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+
+        if saved_key == key:
+            self.cached = cached
+
+    def listdir(self, dir, st):
+        """return list of names in dir, where st is dir's lstat"""
+
+        validator = (st.st_dev, st.st_ino, st.st_mtime, st.st_ctime)
+
+        cached = self.cached.get(dir)
+        if cached and cached[0] == validator:
+            names = cached[1]
+        else:
+            names = "\0".join(os.listdir(dir))
+
+        if max(st.st_mtime, st.st_ctime) < self.started - self.RACY_SECONDS:
+            self.listings[dir] = (validator, names)
+
+        return names.split("\0") if names else []
+
+    def forget(self, dir):
+        """don't use or save dir's listing"""
+        self.cached.pop(dir, None)
+        self.listings.pop(dir, None)
+
+    def save(self):
+        """save listings of directories we walked"""
+        tmp = self.path + ".tmp"
+
+        fh = file(tmp, "wb")
+        os.chmod(tmp, 0600)
+        marshal.dump((self.key, self.listings), fh)
+        fh.close()
+
+        os.rename(tmp, self.path)
+
+class HashCache:
+    """Content digests saved from a previous backup.
+
+    A digest is keyed by the device, inode, size and mtime of the file it was
+    computed from, so a file is only read again after it changes.
+    """
+
+    # files modified this recently may change again without changing their
+    # mtime (filesystem timestamp granularity), so don't save them
+    RACY_SECONDS = DirCache.RACY_SECONDS
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+
+        self.cached = {}
+        self.digests = {}
+
+        try:
+            cached = marshal.load(file(path, "rb"))
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+
+        if isinstance(cached, dict):
+            self.cached = cached
+
+    def digest(self, path):
+        """return hex digest of the contents of path"""
+
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+        digest = self.cached.get(key)
+        if digest is None:
+            digest = file_digest(path)
+
+        if st.st_mtime < self.started - self.RACY_SECONDS:
+            self.digests[key] = digest
+
+        return digest
+
+    def save(self):
+        """save digests of files we looked up"""
+        tmp = self.path + ".tmp"
+
+        fh = file(tmp, "wb")
+        os.chmod(tmp, 0600)
+        marshal.dump(self.digests, fh)
+        fh.close()
+
+        os.rename(tmp, self.path)
+
+def _iterwalk_parallel(roots, skip, workers, tmpdir):
+    """parallel walk that is sorted externally, so memory use stays fixed"""
+
+    Record = DirIndex.Record
+
+    def walk():
+        dirs = []
+        for rec, st in roots:
+            yield rec
+
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(rec.path)
+
+        for rec in _walk_parallel(dirs, skip, workers, Record):
+            yield rec
+
+    items = ( tuple([ getattr(rec, attr) for attr in Record.__slots__ ])
+              for rec in walk() )
+
+    for item in extsort.iter_sorted(items, tmpdir):
+        yield Record(*item)
+
+def iterwalk(*paths, **kws):
+    """walk paths and yield records in sorted path order (i.e., the order
+    DirIndex.save writes them in)
+
+    Keyword arguments:
+
+        cache       DirCache of directory listings to use and update
+                    (serial walks only)
+
+        workers     number of threads scanning directories in parallel
+
+        tmpdir      where parallel walks spill sorted runs to
+    """
+    cache = kws.pop('cache', None)
+    workers = kws.pop('workers', DirIndex.SCAN_WORKERS)
+    tmpdir = kws.pop('tmpdir', None)
+
+    pathmap = PathMap(paths)
+    roots = [ (DirIndex.Record.fromstat(path, st), st)
+              for path, st in _roots(pathmap) ]
+
+    walks = []
+    if workers > 1:
+        walks.append(((rec.path, rec)
+                      for rec in _iterwalk_parallel(roots, pathmap.is_pruned, workers, tmpdir)))
+    else:
+        for rec, st in roots:
+            walks.append(((rec.path, rec)
+                          for rec in _walk_sorted(rec, st, pathmap.is_pruned, DirIndex.Record, cache)))
+
+    # walks pass through directories that lead to wildcard matches
+    # (e.g., /home/bob for /home/*/public) without yielding them
+    filter = pathmap.has_patterns
+
+    # paranoia: a path reached by more than one walk is only yielded once
+    prev = None
+    for path, rec in heapq.merge(*walks):
+        if path != prev and (not filter or path in pathmap):
+            yield rec
+        prev = path
+
+def iterdiff(saved, current, paths=[], digest=None):
+    """merge-join two streams of records sorted by path (e.g., iterload and
+    iterwalk) and yield (change, record) tuples, where change is one of:
+
+        new         file not in saved index
+        edited      file contents changed
+        stat        ownership or permissions changed (or new directory)
+        deleted     saved path no longer exists (limited to paths)
+
+    The record is from the current stream, except for deleted changes.
+    Produces the same changes as DirIndex.diff in a single pass.
+
+    If provided, digest(path) is used to check whether files with a saved
+    content digest were really edited (see _cmp_records)"""
+
+    pathmap = PathMap(paths)
+
+    saved = iter(saved)
+    current = iter(current)
+
+    def next_sorted(records, prev):
+        try:
+            rec = records.next()
+        except StopIteration:
+            return None
+
+        if prev and rec.path <= prev.path:
+            raise Error("index not sorted: %s after %s" % (`rec.path`, `prev.path`))
+
+        return rec
+
+    a = next_sorted(saved, None)
+    b = next_sorted(current, None)
+
+    while a or b:
+        if b is None or (a and a.path < b.path):
+            if a.path in pathmap:
+                yield 'deleted', a
+            a = next_sorted(saved, a)
+
+        elif a is None or b.path < a.path:
+            change = _cmp_new(b)
+            if change:
+                yield change, b
+            b = next_sorted(current, b)
+
+        else:
+            change = _cmp_records(a, b, digest)
+            if change:
+                yield change, b
+            a = next_sorted(saved, a)
+            b = next_sorted(current, b)
+
 def read_paths(fh):
     paths = []
 
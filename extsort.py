@@ -0,0 +1,96 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""External merge sort for more items than we want to hold in memory"""
+import os
+import heapq
+import marshal
+import tempfile
+
+# number of items sorted in memory at a time
+RUN_SIZE = 100000
+
+# number of runs merged at a time (each is an open file)
+FAN_IN = 64
+
+def _spill(items, tmpdir):
+    fd, path = tempfile.mkstemp(prefix="sortrun-", dir=tmpdir)
+    fh = os.fdopen(fd, "wb")
+    try:
+        for item in items:
+            marshal.dump(item, fh)
+    except:
+        fh.close()
+        os.remove(path)
+        raise
+
+    fh.close()
+    return path
+
+def _open(paths):
+    # unlinked runs are deleted when the merge closes them
+    fhs = []
+    for path in paths:
+        fhs.append(file(path, "rb"))
+        os.remove(path)
+
+    return fhs
+
+def _load(fh):
+    try:
+        while True:
+            try:
+                yield marshal.load(fh)
+            except EOFError:
+                return
+    finally:
+        fh.close()
+
+def iter_sorted(items, tmpdir=None, run_size=RUN_SIZE, fan_in=FAN_IN):
+    """Returns an iterator of items in sorted order.
+
+    Items must be marshallable (e.g., tuples of strings and numbers). Up to
+    run_size items are sorted in memory, larger inputs are spilled as sorted
+    runs to temporary files in tmpdir which are merged lazily. If there are
+    more than fan_in runs, they are first merged fan_in at a time into
+    longer runs."""
+
+    runs = []
+    try:
+        buf = []
+        for item in items:
+            buf.append(item)
+            if len(buf) >= run_size:
+                buf.sort()
+                runs.append(_spill(buf, tmpdir))
+                buf = []
+
+        buf.sort()
+
+        # the oldest runs are merged first, so every item is merged about
+        # log(len(runs), fan_in) times
+        while len(runs) > fan_in:
+            fhs = _open(runs[:fan_in])
+            path = _spill(heapq.merge(*[ _load(fh) for fh in fhs ]), tmpdir)
+            runs[:fan_in] = []
+            runs.append(path)
+
+        fhs = _open(runs)
+
+    except:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    if not fhs:
+        return iter(buf)
+
+    return heapq.merge(iter(buf), *[ _load(fh) for fh in fhs ])
@@ -9,17 +9,22 @@
 # the License, or (at your option) any later version.
 #
 import sys
+import itertools
 
 import os
 from os.path import *
 
 import signal
+import select
 import time
 
 import re
 from paths import Paths as _Paths
 
 import shutil
+import hashlib
+import threading
+import tempfile
 from string import Template
 from subprocess import Popen, PIPE
 
@@ -34,7 +39,16 @@ class Error(Exception):
 
 PATH_DEBIAN_CNF = "/etc/mysql/debian.cnf"
 
+# number of mysqldump connections dumping table rows in parallel
+DUMP_WORKERS = 1
+
+# number of mysql connections restoring table rows in parallel
+RESTORE_WORKERS = 1
+
 def _mysql_opts(opts=[], defaults_file=None, **conf):
+    # don't change the caller's list (or our default)
+    opts = list(opts)
+
     def isreadable(path):
         try:
             file(path)
@@ -54,17 +68,32 @@ def _mysql_opts(opts=[], defaults_file=None, **conf):
 
     return " ".join([ "--" + opt for opt in opts ])
 
+def _mysqldump(opts, args=[], **conf):
+    command = "mysqldump " + _mysql_opts(opts, **conf)
+    if args:
+        command += " " + " ".join([ executil.mkarg(arg) for arg in args ])
+
+    # mysqldump would block writing to a stderr pipe nobody reads
+    errors = tempfile.TemporaryFile()
+    popen = Popen(command, shell=True, stderr=errors, stdout=PIPE)
+    popen.errors = errors
+
+    return popen
+
+def _mysqldump_error(popen):
+    popen.errors.seek(0)
+    return Error("mysqldump error (%d): %s" % (popen.returncode, popen.errors.read()))
+
 def mysqldump(**conf):
     opts = [ "all-databases", "skip-extended-insert", "single-transaction",
              "compact", "quick" ]
 
-    command = "mysqldump " + _mysql_opts(opts, **conf)
-    popen = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+    popen = _mysqldump(opts, **conf)
 
     firstline = popen.stdout.readline()
     if not firstline:
-        returncode = popen.wait()
-        raise Error("mysqldump error (%d): %s" % (returncode, popen.stderr.read()))
+        popen.wait()
+        raise _mysqldump_error(popen)
 
     return popen.stdout
 
@@ -79,6 +108,61 @@ def mysql(**conf):
 
     return os.popen(command, "w")
 
+def _mysql_query(sql, **conf):
+    """Run sql with the mysql client. Returns rows of output columns"""
+    command = "mysql " + _mysql_opts([ "batch", "skip-column-names" ], **conf)
+
+    popen = Popen(command, shell=True, stdin=PIPE, stderr=PIPE, stdout=PIPE)
+    output, error = popen.communicate(sql)
+    if popen.returncode != 0:
+        raise Error("mysql error (%d): %s" % (popen.returncode, error))
+
+    return [ line.split("\t") for line in output.splitlines() ]
+
+def _local_infile(**conf):
+    """True if the server allows LOAD DATA LOCAL INFILE"""
+    try:
+        return _mysql_query("SELECT @@local_infile", **conf) == [ [ "1" ] ]
+    except Error:
+        return False
+
+class GlobalReadLock:
+    """Hold FLUSH TABLES WITH READ LOCK on a mysql connection until released.
+
+    Nothing can be written while we hold the lock, so transactions that
+    start meanwhile (e.g., mysqldump --single-transaction) should all see
+    the same snapshot of transactional tables."""
+
+    # FLUSH TABLES waits for running queries, so don't wait forever
+    TIMEOUT = 60
+
+    def __init__(self, timeout=TIMEOUT, **conf):
+        # unbuffered, or the client may sit on our handshake until it exits.
+        # exec, so that on timeout we kill the client, not just the shell
+        command = "exec mysql " + _mysql_opts([ "batch", "skip-column-names", "unbuffered" ], **conf)
+
+        self.popen = Popen(command, shell=True, stdin=PIPE, stderr=PIPE, stdout=PIPE)
+        self.popen.stdin.write("FLUSH TABLES WITH READ LOCK;\nSELECT 'locked';\n")
+        self.popen.stdin.flush()
+
+        if not select.select([ self.popen.stdout ], [], [], timeout)[0]:
+            os.kill(self.popen.pid, signal.SIGTERM)
+            self.release()
+            raise Error("timed out waiting %d seconds for a global read lock" % timeout)
+
+        if self.popen.stdout.readline().strip() != 'locked':
+            self.popen.stdin.close()
+            returncode = self.popen.wait()
+            raise Error("mysql error (%d): %s" % (returncode, self.popen.stderr.read()))
+
+    def release(self):
+        """ends the session, which unlocks the tables"""
+        if self.popen.stdin.closed:
+            return
+
+        self.popen.stdin.close()
+        self.popen.wait()
+
 class MyFS:
     class Database:
         class Paths(_Paths):
@@ -86,7 +170,7 @@ class MyFS:
 
     class Table:
         class Paths(_Paths):
-            files = [ 'init', 'triggers', 'rows' ]
+            files = [ 'init', 'triggers', 'rows', 'rows.tsv' ]
 
     class View:
         class Paths(_Paths):
@@ -97,20 +181,163 @@ def _match_name(sql):
     if m:
         return m.group(1)
     
+# what opens a quoted string or comment, outside of one. Executable comments
+# (e.g., /*!50003 ... */) are SQL, so they aren't comments
+_QUOTE_START = re.compile(r"""['"`#]|/\*(?!!)|--\s""")
+
+# the rest of a quoted string or comment, by what opened it
+_QUOTE_END = {
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL),
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+    '`': re.compile(r"[^`]*`"),
+    '/*': re.compile(r".*?\*/", re.DOTALL)
+}
+
+# a line (or what's left of it) with no open quote or comment at the end.
+# Most lines match in one go, which is a lot faster than scanning token by token
+_CLOSED = re.compile(r"""(?:[^'"`#/-]+|'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*"|`[^`]*`|/\*!|/(?!\*)|-(?!-\s))*""", re.DOTALL)
+
+def _scan_quotes(line, quote=None):
+    """Scan line, starting inside quote (e.g., "'", or None if we aren't in
+    one). Returns the quote that is still open at the end of line"""
+
+    if not quote and _CLOSED.match(line).end() == len(line):
+        return None
+
+    pos = 0
+    while True:
+        if quote:
+            m = _QUOTE_END[quote].match(line, pos)
+            if not m:
+                return quote
+
+            pos = m.end()
+
+        m = _QUOTE_START.search(line, pos)
+        if not m:
+            return None
+
+        quote = m.group()
+        pos = m.end()
+
+        # comment to the end of the line
+        if quote == '#' or quote.startswith('--'):
+            return None
+
 def _parse_statements(fh, delimiter=';'):
-    statement = ""
-    for line in fh.xreadlines():
-        if line.startswith("--"):
-            continue
-        if not line.strip():
-            continue
-        if line.startswith("DELIMITER"):
-            delimiter = line.split()[1]
-            continue
-        statement += line
-        if statement.strip().endswith(delimiter):
-            yield statement.strip()
-            statement = ""
+    """Yield SQL statements from fh in one pass.
+
+    A statement ends with a line that ends with the delimiter outside of a
+    quoted string or comment. Outside statements and quoted strings,
+    comment lines, blank lines and DELIMITER lines are skipped"""
+
+    lines = []
+    quote = None
+    for line in fh:
+        if not quote:
+            if line.startswith("--"):
+                continue
+            if not line.strip():
+                continue
+            if line.startswith("DELIMITER"):
+                delimiter = line.split()[1]
+                continue
+
+        lines.append(line)
+
+        quote = _scan_quotes(line, quote)
+        if not quote and line.rstrip().endswith(delimiter):
+            yield "".join(lines).strip()
+            lines = []
+
+def _insert_values(sql):
+    """Returns the values of a single row INSERT statement (e.g., "1,'a'")"""
+
+    i = sql.find("VALUES (")
+    if i == -1 or not sql.endswith(");") or '\n' in sql:
+        return re.sub(r'.*?VALUES \((.*)\);', '\\1', sql)
+
+    return sql[i + len("VALUES ("):-len(");")]
+
+# values of a row, as mysqldump writes them (binary strings have a
+# _binary introducer, which doesn't match)
+_VALUE = re.compile(r"""'((?:[^'\\]+|\\.|'')*)'|(NULL)|(-?[0-9][0-9.eE+-]*)""", re.DOTALL)
+
+# column types that LOAD DATA can't load from text. Binary strings aren't
+# valid in the CHARACTER SET we load with
+_NOT_TSV = re.compile(r"`\s+(bit|geometry|point|linestring|polygon|multipoint|multilinestring|"
+                      r"multipolygon|geometrycollection|(tiny|medium|long)?blob|(var)?binary)\b",
+                      re.IGNORECASE)
+
+def _tsv_line(values):
+    """Convert the values of a row (e.g., "1,'a',NULL") to a LOAD DATA line
+    (tab separated, backslash escaped). Returns None if a value isn't a
+    (non-binary) string, number or NULL"""
+
+    fields = []
+    pos = 0
+    while True:
+        m = _VALUE.match(values, pos)
+        if not m:
+            return None
+
+        string, null, number = m.groups()
+        if string is not None:
+            # mysqldump's string escapes are LOAD DATA escapes too
+            fields.append(string.replace("''", "\\'").replace("\t", "\\t"))
+        elif null:
+            fields.append("\\N")
+        else:
+            fields.append(number)
+
+        pos = m.end()
+        if pos == len(values):
+            return "\t".join(fields)
+
+        if values[pos] != ',':
+            return None
+        pos += 1
+
+def _tsv_values(line):
+    """Convert a LOAD DATA line back to the values of a row. Numbers are
+    quoted like strings, which MySQL converts back"""
+
+    return ",".join([ "NULL" if field == "\\N" else "'" + field + "'"
+                      for field in line.split("\t") ])
+
+class _RowsFile:
+    """Rows of a table, written as SQL values or (if tsv) LOAD DATA lines.
+    A row that can't be written as a LOAD DATA line turns the file into SQL"""
+
+    def __init__(self, paths, tsv=False, mode="w"):
+        self.paths = paths
+        self.tsv = tsv
+        self.fh = file(paths.rows_tsv if tsv else paths.rows, mode)
+
+    def write(self, values):
+        if self.tsv:
+            line = _tsv_line(values)
+            if line is not None:
+                self.fh.write(line + "\n")
+                return
+
+            self._untsv()
+
+        self.fh.write(values + "\n")
+
+    def _untsv(self):
+        self.fh.close()
+
+        fh = file(self.paths.rows, "a")
+        for line in file(self.paths.rows_tsv):
+            fh.write(_tsv_values(line.rstrip("\n")) + "\n")
+        os.remove(self.paths.rows_tsv)
+
+        self.fh = fh
+        self.tsv = False
+
+    def close(self):
+        self.fh.close()
 
 class MyFS_Writer(MyFS):
     class Database(MyFS.Database):
@@ -138,7 +365,7 @@ class MyFS_Writer(MyFS):
             print >> file(view.paths.post, "w"), sql
 
     class Table(MyFS.Table):
-        def __init__(self, database, name, sql):
+        def __init__(self, database, name, sql, tsv=False):
             self.paths = self.Paths(join(database.paths.tables, name))
             if not exists(self.paths):
                 os.makedirs(self.paths)
@@ -147,19 +374,66 @@ class MyFS_Writer(MyFS):
             if exists(self.paths.triggers):
                 os.remove(self.paths.triggers)
 
-            self.rows_fh = file(self.paths.rows, "w")
+            # rows may be linked to a RowsCache, don't write through
+            for path in (self.paths.rows, self.paths.rows_tsv):
+                if exists(path):
+                    os.remove(path)
+
+            self.rows_fh = _RowsFile(self.paths, tsv)
             self.name = name
             self.database = database
 
-        def add_row(self, sql):
-            print >> self.rows_fh, re.sub(r'.*?VALUES \((.*)\);', '\\1', sql)
+        def add_row(self, values):
+            self.rows_fh.write(values)
 
         def add_trigger(self, sql):
             print >> file(self.paths.triggers, "a"), sql + "\n"
 
-    def __init__(self, outdir, limits=[]):
+    def __init__(self, outdir, limits=[], tsv=False):
+        """if tsv, rows are written as LOAD DATA lines where possible"""
         self.limits = DBLimits(limits)
         self.outdir = outdir
+        self.tsv = tsv
+
+        # (database, table) of tables whose rows are included
+        self.tables = []
+
+    def table_paths(self, database, table):
+        tables = self.Database.Paths(join(self.outdir, database)).tables
+        return self.Table.Paths(join(tables, table))
+
+    def rows_path(self, database, table):
+        paths = self.table_paths(database, table)
+        if exists(paths.rows_tsv):
+            return paths.rows_tsv
+
+        return paths.rows
+
+    def rows_fromfile(self, fh, database=None):
+        """Add rows from a dump of table data only (e.g., mysqldump
+        --no-create-info) to tables created by fromfile. Rows are in
+        database, unless the dump says otherwise (i.e., USE statements)"""
+
+        name = None
+        rows_fh = None
+        for statement in _parse_statements(fh):
+            if statement.startswith("INSERT INTO"):
+                if _match_name(statement) != name:
+                    if rows_fh:
+                        rows_fh.close()
+
+                    name = _match_name(statement)
+                    paths = self.table_paths(database, name)
+                    rows_fh = _RowsFile(paths, exists(paths.rows_tsv), "a")
+
+                rows_fh.write(_insert_values(statement))
+
+            elif statement.startswith("USE "):
+                database = _match_name(statement)
+                name = None
+
+        if rows_fh:
+            rows_fh.close()
 
     def fromfile(self, fh, callback=None):
         databases = {}
@@ -167,6 +441,14 @@ class MyFS_Writer(MyFS):
         table = None
 
         for statement in _parse_statements(fh):
+            # rows are most of a dump, so they go straight to the table
+            if statement.startswith("INSERT INTO"):
+                if database and table and not table_ignore_inserts:
+                    assert _match_name(statement) == table.name
+                    table.add_row(_insert_values(statement))
+
+                continue
+
             if statement.startswith("CREATE DATABASE"):
                 database_name = _match_name(statement)
 
@@ -203,11 +485,13 @@ class MyFS_Writer(MyFS):
             elif statement.startswith("CREATE TABLE"):
                 table_name = _match_name(statement)
 
-                table = self.Table(database, table_name, statement)
+                table = self.Table(database, table_name, statement,
+                                   self.tsv and not _NOT_TSV.search(statement))
                 if (database.name, table_name) in self.limits:
                     if callback:
                         callback(table)
 
+                    self.tables.append((database.name, table_name))
                     table_ignore_inserts = False
                 else:
                     table_ignore_inserts = True
@@ -218,12 +502,315 @@ class MyFS_Writer(MyFS):
             if re.match(r'^/\*!50003 CREATE.* TRIGGER ', statement, re.DOTALL):
                 table.add_trigger(statement)
 
-            elif not table_ignore_inserts and statement.startswith("INSERT INTO"):
-                assert _match_name(statement) == table.name
-                table.add_row(statement)
+def mysql2fs(fh, outdir, limits=[], callback=None, tsv=False):
+    MyFS_Writer(outdir, limits, tsv).fromfile(fh, callback)
+
+def _dump_groups(tables, sizes, workers):
+    """Split tables between workers, balancing their sizes. Databases larger
+    than a worker's share are split into tables, otherwise they are dumped
+    whole. Returns a list of dumps per worker, where a dump is (database,
+    tables) or (None, databases) for whole databases."""
+
+    total = sum([ sizes.get(table, 0) for table in tables ])
+    share = total / workers
+
+    databases = []
+    for database, table in tables:
+        if database not in databases:
+            databases.append(database)
 
-def mysql2fs(fh, outdir, limits=[], callback=None):
-    MyFS_Writer(outdir, limits).fromfile(fh, callback)
+    units = []
+    for database in databases:
+        included = [ table for db, table in tables if db == database ]
+        size = sum([ sizes.get((database, table), 0) for table in included ])
+
+        # whole databases include tables that limits would exclude
+        whole = len(included) == len([ db for db, table in sizes if db == database ])
+
+        if whole and (size <= share or len(included) == 1):
+            units.append((size, database, None))
+        else:
+            for table in included:
+                units.append((sizes.get((database, table), 0), database, table))
+
+    # largest first, each to the least loaded worker
+    units.sort(lambda a, b: cmp(b[0], a[0]))
+
+    loads = [ 0 ] * workers
+    assigned = [ [] for i in range(workers) ]
+    for size, database, table in units:
+        i = loads.index(min(loads))
+        loads[i] += size
+        assigned[i].append((database, table))
+
+    groups = []
+    for units in assigned:
+        dumps = []
+
+        whole = [ database for database, table in units if table is None ]
+        if whole:
+            dumps.append((None, whole))
+
+        for database in databases:
+            split = [ table for db, table in units if db == database and table ]
+            if split:
+                dumps.append((database, split))
+
+        if dumps:
+            groups.append(dumps)
+
+    return groups
+
+def _dump_args(dumps, sizes):
+    """Arguments for dumping a worker's dumps (see _dump_groups) with one
+    mysqldump --databases: tables of split databases that aren't in dumps
+    are ignored"""
+
+    databases = []
+    ignored = []
+    for database, names in dumps:
+        if database is None:
+            databases += names
+            continue
+
+        databases.append(database)
+        ignored += [ "--ignore-table=%s.%s" % (db, table) for db, table in sorted(sizes)
+                     if db == database and table not in names ]
+
+    return ignored + databases
+
+def _link(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+class RowsCache:
+    """Rows of tables saved from a previous backup.
+
+    Rows are keyed by a fingerprint of the table, so a table that hasn't
+    changed since can reuse its rows instead of being dumped again. Rows
+    are hard linked (or copied across filesystems) in and out of the cache.
+    """
+
+    class Paths(_Paths):
+        files = [ 'fingerprints', 'rows' ]
+
+    def __init__(self, path):
+        self.paths = self.Paths(path)
+
+        # (database, table) -> fingerprint
+        self.cached = {}
+        self.fingerprints = {}
+
+        try:
+            fh = file(self.paths.fingerprints)
+        except IOError:
+            return
+
+        for line in fh:
+            try:
+                database, table, fingerprint = line.rstrip("\n").split("\t")
+            except ValueError:
+                continue
+
+            self.cached[(database, table)] = fingerprint
+
+    def _rows(self, database, table):
+        return join(self.paths.rows, database, table)
+
+    def get(self, database, table, fingerprint, dest):
+        """link cached rows to dest if the table's fingerprint is unchanged.
+        Returns True if it was"""
+
+        if fingerprint is None or self.cached.get((database, table)) != fingerprint:
+            return False
+
+        rows = self._rows(database, table)
+        if not exists(rows):
+            return False
+
+        if exists(dest):
+            os.remove(dest)
+
+        _link(rows, dest)
+        self.fingerprints[(database, table)] = fingerprint
+        return True
+
+    def put(self, database, table, fingerprint, rows):
+        """cache rows of a table we dumped (unless it has no fingerprint)"""
+
+        cached = self._rows(database, table)
+        if exists(cached):
+            os.remove(cached)
+
+        if fingerprint is None:
+            self.cached.pop((database, table), None)
+            return
+
+        if not exists(dirname(cached)):
+            os.makedirs(dirname(cached))
+
+        _link(rows, cached)
+        self.fingerprints[(database, table)] = fingerprint
+
+    def save(self, existing=()):
+        """save fingerprints of tables we got or put. Other cached tables
+        are dropped unless they're in existing (e.g., excluded by limits)"""
+
+        if not exists(self.paths):
+            os.makedirs(self.paths)
+            os.chmod(self.paths, 0700)
+
+        for (database, table), fingerprint in self.cached.items():
+            if (database, table) in self.fingerprints:
+                continue
+
+            if (database, table) in existing:
+                self.fingerprints[(database, table)] = fingerprint
+                continue
+
+            rows = self._rows(database, table)
+            if exists(rows):
+                os.remove(rows)
+
+            try:
+                os.rmdir(dirname(rows))
+            except OSError:
+                pass
+
+        tmp = self.paths.fingerprints + ".tmp"
+
+        fh = file(tmp, "w")
+        os.chmod(tmp, 0600)
+        for (database, table), fingerprint in sorted(self.fingerprints.items()):
+            print >> fh, "\t".join([ database, table, fingerprint ])
+        fh.close()
+
+        os.rename(tmp, self.paths.fingerprints)
+
+# engines that keep UPDATE_TIME up to date (InnoDB since MySQL 5.7, and
+# only for tables that aren't partitioned)
+FINGERPRINT_ENGINES = ('MyISAM', 'Aria', 'InnoDB')
+
+def _fingerprint(init, engine, create_options, update_time, now):
+    """fingerprint of a table's schema and data, or None if we can't tell
+    when its data changed (no UPDATE_TIME, or an engine that doesn't keep it
+    reliably). Tables updated in the current second may change again
+    without changing their UPDATE_TIME, so they have no fingerprint"""
+
+    if engine not in FINGERPRINT_ENGINES or 'partitioned' in create_options:
+        return None
+
+    if not update_time.isdigit() or int(update_time) >= int(now):
+        return None
+
+    digest = hashlib.sha1(file(init).read()).hexdigest()
+    return "%s %s %s" % (engine, update_time, digest)
+
+def mysql2fs_parallel(outdir, limits=[], callback=None, workers=DUMP_WORKERS, cache=None, tsv=False,
+                      **conf):
+    """Like mysql2fs(mysqldump(), ...) but table rows are dumped by up to
+    workers mysqldump connections in parallel.
+
+    Each mysqldump --single-transaction starts its transaction while we
+    hold a global read lock (FTWRL), so transactional (e.g., InnoDB) tables
+    should be dumped from one snapshot. Like a single mysqldump
+    --single-transaction, that doesn't hold for MyISAM tables, which are
+    read after the lock is released. Writes are blocked until the last
+    mysqldump has started (not finished).
+
+    If cache is a RowsCache, tables that haven't changed since they were
+    cached reuse their cached rows instead of being dumped."""
+
+    writer = MyFS_Writer(outdir, limits, tsv)
+
+    lock = GlobalReadLock(**conf)
+    try:
+        # databases, tables, views and triggers (without rows)
+        popen = _mysqldump([ "all-databases", "no-data", "single-transaction",
+                             "compact", "quick" ], **conf)
+        writer.fromfile(popen.stdout, callback)
+        if popen.wait() != 0:
+            raise _mysqldump_error(popen)
+
+        sizes = {}
+        fingerprints = {}
+        included = set(writer.tables)
+        # MySQL 8 caches table statistics (e.g., UPDATE_TIME) for a day
+        for database, table, size, engine, create_options, update_time, now in \
+                _mysql_query("/*!80003 SET SESSION information_schema_stats_expiry = 0 */;\n"
+                             "SELECT TABLE_SCHEMA, TABLE_NAME, DATA_LENGTH, ENGINE, CREATE_OPTIONS, "
+                             "UNIX_TIMESTAMP(UPDATE_TIME), UNIX_TIMESTAMP() "
+                             "FROM information_schema.TABLES "
+                             "WHERE TABLE_TYPE = 'BASE TABLE'", **conf):
+            sizes[(database, table)] = int(size) if size.isdigit() else 0
+
+            if cache and (database, table) in included:
+                init = writer.table_paths(database, table).init
+                rows = writer.rows_path(database, table)
+
+                # rows are cached in the format they're written in
+                fingerprint = _fingerprint(init, engine, create_options, update_time, now)
+                if fingerprint:
+                    fingerprint += " " + basename(rows)
+
+                fingerprints[(database, table)] = (fingerprint, rows)
+
+        tables = writer.tables
+        if cache:
+            tables = [ (database, table) for database, table in tables
+                       if not cache.get(database, table,
+                                        *fingerprints.get((database, table), (None, None))) ]
+
+        opts = [ "skip-extended-insert", "single-transaction", "compact", "quick",
+                 "no-create-info", "skip-triggers", "no-create-db", "databases" ]
+
+        # one mysqldump per worker, so every transaction starts under the lock
+        popens = [ _mysqldump(opts, _dump_args(dumps, sizes), **conf)
+                   for dumps in _dump_groups(tables, sizes, workers) ]
+
+        # mysqldump writes (USE `database`) once its transaction has started
+        dumps = [ (popen, popen.stdout.readline()) for popen in popens ]
+
+    finally:
+        lock.release()
+
+    errors = []
+    def dump(popen, firstline):
+        try:
+            if not errors:
+                lines = itertools.chain([ firstline ], popen.stdout)
+                writer.rows_fromfile(lines)
+        except:
+            errors.append(sys.exc_info())
+
+        popen.stdout.close()
+        if popen.wait() != 0 and not errors:
+            errors.append((Error, _mysqldump_error(popen), None))
+
+    threads = [ threading.Thread(target=dump, args=dump_args) for dump_args in dumps ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+    if cache:
+        for database, table in tables:
+            fingerprint, rows = fingerprints.get((database, table), (None, None))
+
+            # rows that turned out not to be LOAD DATA lines change format
+            if rows != writer.rows_path(database, table):
+                fingerprint = None
+
+            cache.put(database, table, fingerprint, writer.rows_path(database, table))
+
+        # tables excluded by limits stay cached until they're dropped
+        cache.save(sizes)
 
 def chunkify(elements, delim, maxlen):
     chunk = ""
@@ -334,7 +921,10 @@ $sql
                 yield view
         views = property(views)
 
-        def tofile(self, fh, callback=None):
+        def tofile(self, fh, callback=None, rows=True):
+            """if not rows, just create the database and its tables (and
+            don't load rows or triggers). Returns the tables"""
+
             if callback:
                 callback(self)
 
@@ -343,15 +933,24 @@ $sql
             print >> fh, self.sql_init,
             print >> fh, "USE `%s`;" % self.name
 
+            tables = []
             for table in self.tables:
                 if callback:
                     callback(table)
-                table.tofile(fh)
+
+                if rows:
+                    table.tofile(fh)
+                else:
+                    table.tofile_init(fh)
+
+                tables.append(table)
 
             for view in self.views:
                 if view.pre:
                     print >> fh, "\n" + view.pre
 
+            return tables
+
     class Table(MyFS.Table):
         TPL_CREATE = """\
 SET @saved_cs_client     = @@character_set_client;
@@ -368,6 +967,13 @@ LOCK TABLES `$name` WRITE;
         TPL_INSERT_POST = """\
 /*!40000 ALTER TABLE `$name` ENABLE KEYS */;
 UNLOCK TABLES;
+"""
+
+        # LOAD DATA LOCAL can't abort the upload, so errors (e.g., duplicate
+        # keys) are demoted to warnings and the rows skipped. Show them
+        TPL_LOAD_DATA = """\
+LOAD DATA LOCAL INFILE '$path' INTO TABLE `$name` CHARACTER SET utf8;
+SHOW WARNINGS;
 """
 
         TPL_TRIGGERS_PRE = """\
@@ -398,12 +1004,23 @@ DELIMITER ;
         def __repr__(self):
             return "Table(%s)" % `self.paths.path`
 
+        def rows_path(self):
+            if exists(self.paths.rows_tsv):
+                return self.paths.rows_tsv
+            return self.paths.rows
+        rows_path = property(rows_path)
+
         def rows(self):
+            if self.rows_path == self.paths.rows_tsv:
+                for line in file(self.paths.rows_tsv).xreadlines():
+                    yield _tsv_values(line.rstrip("\n"))
+                return
+
             for line in file(self.paths.rows).xreadlines():
                 yield line.strip()
 
         def has_rows(self):
-            if exists(self.paths.rows) and os.lstat(self.paths.rows).st_size != 0:
+            if exists(self.rows_path) and os.lstat(self.rows_path).st_size != 0:
                 return True
             return False
 
@@ -416,23 +1033,37 @@ DELIMITER ;
             return list(_parse_statements(file(self.paths.triggers), ';;'))
         triggers = property(triggers)
 
-        def tofile(self, fh):
-            skip_extended_insert = self.database.myfs.skip_extended_insert
-            max_extended_insert = self.database.myfs.max_extended_insert
+        def is_log_table(self):
+            return self.database.name == "mysql" and self.name in ('general_log', 'slow_log')
+        is_log_table = property(is_log_table)
 
-            is_log_table = (self.database.name == "mysql" and self.name in ('general_log', 'slow_log'))
+        def tofile(self, fh):
+            self.tofile_init(fh)
+            self.tofile_rows(fh)
+            self.tofile_triggers(fh)
 
-            if not is_log_table:
+        def tofile_init(self, fh):
+            if not self.is_log_table:
                 print >> fh, "DROP TABLE IF EXISTS `%s`;" % self.name
 
             print >> fh, Template(self.TPL_CREATE).substitute(init=self.sql_init)
 
+        def tofile_rows(self, fh):
+            skip_extended_insert = self.database.myfs.skip_extended_insert
+            max_extended_insert = self.database.myfs.max_extended_insert
+
+            is_log_table = self.is_log_table
+
             if self.has_rows():
                 if not is_log_table:
                     print >> fh, Template(self.TPL_INSERT_PRE).substitute(name=self.name).strip()
 
                 insert_prefix = "INSERT INTO `%s` VALUES " % self.name
-                if skip_extended_insert:
+                if self.database.myfs.load_data and self.rows_path == self.paths.rows_tsv:
+                    path = abspath(self.paths.rows_tsv).replace("\\", "\\\\").replace("'", "\\'")
+                    print >> fh, Template(self.TPL_LOAD_DATA).substitute(path=path, name=self.name),
+
+                elif skip_extended_insert:
                     for  row in self.rows:
                         print >> fh, insert_prefix + "(%s);" % row
                         
@@ -453,6 +1084,7 @@ DELIMITER ;
                 if not is_log_table:
                     print >> fh, Template(self.TPL_INSERT_POST).substitute(name=self.name)
 
+        def tofile_triggers(self, fh):
             if self.triggers:
                 print >> fh, self.TPL_TRIGGERS_PRE.strip()
                 for trigger in self.triggers:
@@ -486,11 +1118,16 @@ DELIMITER ;
     def __init__(self, path, limits=[], 
                  skip_extended_insert=False,
                  add_drop_database=False,
-                 max_extended_insert=None):
+                 max_extended_insert=None,
+                 load_data=False):
+        """if load_data, LOAD DATA LOCAL INFILE rows written as LOAD DATA
+        lines (the mysql client needs --local-infile)"""
+
         self.path = path
         self.limits = DBLimits(limits)
         self.skip_extended_insert = skip_extended_insert
         self.add_drop_database = add_drop_database
+        self.load_data = load_data
 
         if max_extended_insert is None:
             max_extended_insert = self.MAX_EXTENDED_INSERT
@@ -519,9 +1156,106 @@ DELIMITER ;
 
         print >> fh, self.POST
 
-def fs2mysql(fh, myfs, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False):
+    def tofiles(self, connect, workers=RESTORE_WORKERS, callback=None):
+        """Like tofile, but table rows are loaded by up to workers
+        connections in parallel. connect() returns a new connection (e.g.,
+        mysql()) which is done with what we wrote to it once it's closed.
+
+        Databases and tables are created first, on one connection. Then
+        rows are loaded, largest tables first. Triggers and views come
+        last, after all the rows are in."""
+
+        fh = connect()
+        try:
+            print >> fh, self.PRE
+
+            tables = []
+            for database in self:
+                tables += database.tofile(fh, callback, rows=False)
+
+            print >> fh, self.POST
+        finally:
+            _close(fh)
+
+        # largest last, so they're popped first
+        tables = [ table for table in tables if table.has_rows() ]
+        tables.sort(lambda a, b: cmp(os.lstat(a.rows_path).st_size,
+                                     os.lstat(b.rows_path).st_size))
+
+        lock = threading.Lock()
+        errors = []
+        def load():
+            fh = None
+            try:
+                fh = connect()
+                print >> fh, self.PRE
+                while not errors:
+                    lock.acquire()
+                    try:
+                        if not tables:
+                            break
+                        table = tables.pop()
+                    finally:
+                        lock.release()
+
+                    print >> fh, "USE `%s`;" % table.database.name
+                    table.tofile_rows(fh)
+
+                print >> fh, self.POST
+                _close(fh)
+
+            except:
+                errors.append(sys.exc_info())
+
+                try:
+                    if fh:
+                        fh.close()
+                except IOError:
+                    pass
+
+        threads = [ threading.Thread(target=load) for i in range(min(workers, len(tables))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+        fh = connect()
+        try:
+            print >> fh, self.PRE
+
+            for database in self:
+                print >> fh, "USE `%s`;" % database.name
+                for table in database.tables:
+                    table.tofile_triggers(fh)
+
+                for view in database.views:
+                    if view.post:
+                        print >> fh, "\n" + view.post
+
+            print >> fh, self.POST
+        finally:
+            _close(fh)
 
-    MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database).tofile(fh, callback)
+def _close(fh):
+    status = fh.close()
+    if status:
+        raise Error("mysql error (%d)" % (status >> 8))
+
+def fs2mysql(fh, myfs, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False,
+             load_data=False):
+
+    MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database,
+                load_data=load_data).tofile(fh, callback)
+
+def fs2mysql_parallel(connect, myfs, limits=[], callback=None, skip_extended_insert=False, add_drop_database=False,
+                      workers=RESTORE_WORKERS, load_data=False):
+
+    MyFS_Reader(myfs, limits, skip_extended_insert, add_drop_database,
+                load_data=load_data).tofiles(connect, workers, callback)
 
 def cb_print(fh=None):
     if not fh:
@@ -552,13 +1286,18 @@ def backup(myfs, etc, **kws):
     if not MysqlService.is_accessible():
         mna = MysqlNoAuth()
 
-    try:
-        mysqldump_fh = mysqldump()
+    workers = kws.pop('workers', DUMP_WORKERS)
+    cache = kws.pop('cache', None)
+    tsv = kws.pop('tsv', False)
 
+    try:
         if not exists(myfs):
             os.mkdir(myfs)
 
-        mysql2fs(mysqldump_fh, myfs, **kws)
+        if workers > 1 or cache:
+            mysql2fs_parallel(myfs, workers=workers, cache=cache, tsv=tsv, **kws)
+        else:
+            mysql2fs(mysqldump(), myfs, tsv=tsv, **kws)
 
         if not exists(etc):
             os.mkdir(etc)
@@ -575,9 +1314,13 @@ def restore(myfs, etc, **kws):
     else:
         simulate = False
 
+    workers = kws.pop('workers', RESTORE_WORKERS)
+    load_data = kws.pop('load_data', True)
+
     mna = None
     if simulate:
-        mysql_fh = file("/dev/null", "w")
+        connect = lambda: file("/dev/null", "w")
+        load_data = False
     else:
         if not MysqlService.is_running():
             raise Error("MySQL service not running")
@@ -585,11 +1328,22 @@ def restore(myfs, etc, **kws):
         if not MysqlService.is_accessible():
             mna = MysqlNoAuth()
 
-        mysql_fh = mysql()
+        # rows saved as LOAD DATA lines are bulk loaded if the server lets us
+        if load_data and _local_infile():
+            connect = lambda: mysql(local_infile="1")
+        else:
+            connect = mysql
+            load_data = False
+
+    kws['load_data'] = load_data
 
     try:
-        fs2mysql(mysql_fh, myfs, **kws)
-        mysql_fh.close()
+        if workers > 1:
+            fs2mysql_parallel(connect, myfs, workers=workers, **kws)
+        else:
+            mysql_fh = connect()
+            fs2mysql(mysql_fh, myfs, **kws)
+            mysql_fh.close()
     finally:
         if mna:
             mna.stop()
@@ -8,25 +8,47 @@
 # published by the Free Software Foundation; either version 3 of
 # the License, or (at your option) any later version.
 #
-import glob
+import re
+import fnmatch
 from os.path import *
 
+def _needsglob(path):
+    for c in ('*?[]'):
+        if c in path:
+            return True
+    return False
+
 class PathMap(dict):
-    @staticmethod
-    def _expand(path):
-        def needsglob(path):
-            for c in ('*?[]'):
-                if c in path:
-                    return True
-            return False
+    """Map of paths to signs (True = include, False = exclude).
+
+    A path is included or excluded according to the deepest path in the map
+    that it is (or is beneath). Paths may contain glob wildcards, which are
+    matched lazily one path component at a time:
+
+        * ? [...]   match within a path component, like glob they don't
+                    match a leading dot unless the pattern has one
+
+        **          matches any number of path components
+    """
+
+    class Node(object):
+        """trie node for a path component"""
+        __slots__ = ('children', 'patterns', 'globstar', 'is_globstar', 'mark')
+
+        def __init__(self, is_globstar=False):
+            self.children = {}
+            self.patterns = {}
+            self.globstar = None
+            self.is_globstar = is_globstar
 
-        path = abspath(path)
-        if needsglob(path):
-            return glob.glob(path)
-        else:
-            return [ path ]
+            # (order, sign) of the path that ends here
+            self.mark = None
 
     def __init__(self, paths):
+        self.root = self.Node()
+        self.has_patterns = False
+        self.order = 0
+
         self.default = True
         for path in paths:
             if path[0] == '-':
@@ -36,21 +58,213 @@ class PathMap(dict):
                 self.default = False
                 sign = True
 
-            for expanded in self._expand(path):
-                self[expanded] = sign
+            self[abspath(path)] = sign
+
+    def __setitem__(self, path, sign):
+        dict.__setitem__(self, path, sign)
+
+        node = self.root
+        for name in path.split('/'):
+            if not name:
+                continue
+
+            if name == '**':
+                if node.globstar is None:
+                    node.globstar = self.Node(is_globstar=True)
+                node = node.globstar
+                self.has_patterns = True
+
+            elif _needsglob(name):
+                if name not in node.patterns:
+                    node.patterns[name] = (re.compile(fnmatch.translate(name)), self.Node())
+                node = node.patterns[name][1]
+                self.has_patterns = True
+
+            else:
+                node = node.children.setdefault(name, self.Node())
+
+        # later paths take precedence over earlier paths at the same depth
+        self.order += 1
+        node.mark = (self.order, sign)
+
+    @staticmethod
+    def _closure(nodes):
+        # ** matches zero components too
+        closure = []
+        for node in nodes:
+            while node is not None and node not in closure:
+                closure.append(node)
+                node = node.globstar
+
+        return closure
+
+    def _step(self, nodes, name):
+        hidden = name.startswith('.')
+
+        matched = []
+        for node in nodes:
+            child = node.children.get(name)
+            if child:
+                matched.append(child)
+
+            for pattern, (regex, child) in node.patterns.iteritems():
+                if hidden and not pattern.startswith('.'):
+                    continue
+
+                if regex.match(name):
+                    matched.append(child)
+
+            if node.is_globstar:
+                matched.append(node)
+
+        return self._closure(matched)
+
+    def _match(self, path):
+        """returns (deepest, last) marks: deepest is the mark of the deepest
+        path in the map that path is or is beneath. last is the mark for path
+        itself. Marks are None if there is no match"""
+
+        deepest = last = None
+
+        nodes = self._closure([ self.root ])
+        for name in path.split('/'):
+            if not name:
+                continue
+
+            nodes = self._step(nodes, name)
+            if not nodes:
+                return deepest, None
+
+            marks = [ node.mark for node in nodes if node.mark ]
+            last = max(marks) if marks else None
+            if last:
+                deepest = last
+
+        return deepest, last
 
     def includes(self):
-        return [ path for path in self if self[path] ]
+        """paths that walks start from: included paths, and for paths with
+        wildcards the directory before the first wildcard (e.g., /home for
+        /home/*/public). What's beneath is matched during the walk"""
+
+        includes = []
+        seen = set()
+        for path in self:
+            if not self[path]:
+                continue
+
+            if _needsglob(path):
+                names = path.split('/')
+                while _needsglob('/'.join(names)):
+                    names.pop()
+                path = '/'.join(names) or '/'
+
+            elif self.has_patterns:
+                # overridden by a later exclusion at the same depth
+                deepest, last = self._match(path)
+                if not (last and last[1]):
+                    continue
+
+            if path not in seen:
+                seen.add(path)
+                includes.append(path)
+
+        return includes
     includes = property(includes)
 
     def excludes(self):
         return [ path for path in self if not self[path] ]
     excludes = property(excludes)
 
+    def _marked_beneath(self, path, sign):
+        """True if the map has a path with sign beneath path (conservative:
+        we don't check whether it is overridden)"""
+
+        nodes = self._closure([ self.root ])
+        for name in path.split('/'):
+            if not name:
+                continue
+
+            nodes = self._step(nodes, name)
+            if not nodes:
+                return False
+
+        def descend(node):
+            nodes = node.children.values()
+            nodes += [ child for regex, child in node.patterns.values() ]
+            if node.globstar:
+                nodes.append(node.globstar)
+
+            return nodes
+
+        # a ** matching path also matches what's beneath it
+        stack = [ node for node in nodes if node.is_globstar ]
+        for node in nodes:
+            stack += descend(node)
+
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+
+            if node.mark and node.mark[1] is sign:
+                return True
+
+            stack += descend(node)
+
+        return False
+
+    def excluded_beneath(self, path):
+        """True if a path beneath path may be excluded"""
+        return self._marked_beneath(path, False)
+
+    def is_excluded(self, path):
+        """True if path itself (rather than one of its parents) is excluded"""
+        if not self.has_patterns:
+            return dict.get(self, path) is False
+
+        deepest, last = self._match(path)
+        return last is not None and last[1] is False
+
+    def is_pruned(self, path):
+        """True if walks don't need path: it isn't included and no path
+        beneath it may be (e.g., /home/bob/private for /home/*/public)"""
+        if not self.has_patterns:
+            return dict.get(self, path) is False
+
+        deepest, last = self._match(path)
+        if deepest is not None and deepest[1]:
+            return False
+
+        return not self._marked_beneath(path, True)
+
     def __contains__(self, path):
-        while path not in ('', '/'):
-            if dict.__contains__(self, path):
-                return self[path]
-            path = dirname(path)
+        """the sign of the deepest path in the map that path is (or is
+        beneath) decides. O(depth) whatever the size of the map"""
+
+        if not path.startswith('/'):
+            return self.default
+
+        if self.has_patterns:
+            deepest, last = self._match(path)
+            if deepest is None:
+                return self.default
+
+            return deepest[1]
+
+        sign = self.default
+        node = self.root
+        for name in path.split('/'):
+            if not name:
+                continue
+
+            node = node.children.get(name)
+            if node is None:
+                break
+
+            if node.mark:
+                sign = node.mark[1]
 
-        return self.default
+        return sign
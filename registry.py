@@ -66,7 +66,7 @@ Run "tklbam-init --help" for further details.
 
     class Paths(_Paths):
         files = ['restore.log', 'backup.log', 'backup.pid',
-                 'backup-resume', 'sub_apikey', 'secret', 'key', 'credentials', 'hbr',
+                 'backup-resume', 'dircache', 'hashcache', 'mysqlcache', 'sub_apikey', 'secret', 'key', 'credentials', 'hbr',
                  'profile', 'profile/stamp', 'profile/profile_id']
 
     def __init__(self, path=None):
@@ -16,7 +16,8 @@ from os.path import *
 import userdb
 import pkgman
 
-from changes import Changes
+import deltafile
+from changes import ChangesFile, apply_actions, set_userdb, APPLY_WORKERS
 from pathmap import PathMap
 from rollback import Rollback
 
@@ -44,7 +45,8 @@ class Restore:
 
     PACKAGES_BLACKLIST = ['linux-*', 'vmware-tools*']
 
-    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False):
+    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False, mysql_restore_workers=1,
+                 apply_workers=APPLY_WORKERS):
         self.extras = backup.ExtrasPaths(backup_extract_path)
         if not isdir(self.extras.path):
             raise self.Error("illegal backup_extract_path: can't find '%s'" % self.extras.path)
@@ -56,6 +58,8 @@ class Restore:
                     if exists(self.extras.backup_conf) else None
 
         self.simulate = simulate
+        self.mysql_restore_workers = mysql_restore_workers
+        self.apply_workers = apply_workers
         self.rollback = Rollback.create() if rollback else None
         self.limits = conf.Limits(limits)
         self.backup_extract_path = backup_extract_path
@@ -64,8 +68,11 @@ class Restore:
         if not exists(self.extras.myfs) and not exists(self.extras.pgfs):
             return
 
+        # only snapshot what we're about to restore
         if self.rollback:
-            self.rollback.save_database()
+            self.rollback.save_database(self.limits.mydb, self.limits.pgdb,
+                                        skip_mysql=not exists(self.extras.myfs),
+                                        skip_pgsql=not exists(self.extras.pgfs))
 
         if exists(self.extras.myfs):
 
@@ -73,7 +80,8 @@ class Restore:
 
             try:
                 mysql.restore(self.extras.myfs, self.extras.etc.mysql,
-                              limits=self.limits.mydb, callback=mysql.cb_print(), simulate=self.simulate)
+                              limits=self.limits.mydb, callback=mysql.cb_print(), simulate=self.simulate,
+                              workers=self.mysql_restore_workers)
 
             except mysql.Error, e:
                 print "SKIPPING MYSQL DATABASE RESTORE: " + str(e)
@@ -162,9 +170,10 @@ class Restore:
     @staticmethod
     def _get_fsdelta_olist(fsdelta_olist_path, limits=[]):
         pathmap = PathMap(limits)
-        return [ fpath 
-                 for fpath in file(fsdelta_olist_path).read().splitlines() 
-                 if fpath in pathmap ] 
+        fpaths = ( line.rstrip("\n")
+                   for line in deltafile.iterlines(fsdelta_olist_path) )
+
+        return [ fpath for fpath in fpaths if fpath in pathmap ]
 
     @staticmethod
     def _apply_overlay(src, dst, olist):
@@ -189,6 +198,9 @@ class Restore:
 
         passwd, group, uidmap, gidmap = self._userdb_merge(extras.etc, "/etc")
 
+        # fixes are for the merged users and groups we're about to write
+        set_userdb(passwd, group)
+
         if uidmap or gidmap:
             print "MERGING USERS AND GROUPS:\n"
 
@@ -199,13 +211,22 @@ class Restore:
 
             print
 
-        changes = Changes.fromfile(extras.fsdelta, limits)
-        deleted = list(changes.deleted())
+        changes = ChangesFile(extras.fsdelta, limits)
 
         if rollback:
             rollback.save_files(changes, overlay)
 
-        fsdelta_olist = self._get_fsdelta_olist(extras.fsdelta_olist, limits)
+        # decide what to delete before the overlay changes things. Rollback
+        # snapshots files in place but moves deleted directories away
+        deleted = list(changes.deleted())
+
+        if limits:
+            # fsdelta-olist may include new directories whole, which limits
+            # can't filter, so we use the exact list of files from fsdelta
+            fsdelta_olist = [ change.path for change in changes
+                              if change.OP == 'o' ]
+        else:
+            fsdelta_olist = self._get_fsdelta_olist(extras.fsdelta_olist)
         if fsdelta_olist:
             print "OVERLAY:\n"
             for fpath in fsdelta_olist:
@@ -216,24 +237,25 @@ class Restore:
 
             print
 
-        statfixes = list(changes.statfixes(uidmap, gidmap))
-
-        if statfixes or deleted:
-            print "POST-OVERLAY FIXES:\n"
+        fixed = []
+        def log(action):
+            if not fixed:
+                print "POST-OVERLAY FIXES:\n"
+                fixed.append(True)
 
-        for action in statfixes:
             print "  " + str(action)
-            if not simulate:
-                action()
 
-        for action in deleted:
-            print "  " + str(action)
+        def run(actions):
+            if simulate:
+                for action in actions:
+                    log(action)
+            else:
+                apply_actions(actions, self.apply_workers, callback=log)
 
-            # rollback moves deleted to 'originals'
-            if not simulate and not rollback:
-                action()
+        run(changes.statfixes(uidmap, gidmap))
+        run(deleted)
 
-        if statfixes or deleted:
+        if fixed:
             print
 
         def w(path, s):
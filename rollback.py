@@ -13,7 +13,9 @@ import sys
 from os.path import *
 
 import stat
+import fcntl
 import shutil
+import threading
 
 from datetime import datetime
 from paths import Paths as _Paths
@@ -21,7 +23,7 @@ from paths import Paths as _Paths
 import mysql
 import pgsql
 
-from changes import Changes
+from changes import Changes, ChangesFile, apply_actions, mkdir, APPLY_WORKERS
 from dirindex import DirIndex
 from pkgman import Packages
 
@@ -31,6 +33,73 @@ import traceback
 class Error(Exception):
     pass
 
+# ioctl(dest, FICLONE, source) shares source's extents with dest (e.g., btrfs, xfs)
+FICLONE = 0x40049409
+
+def _reflink(source, dest):
+    """clone regular file source to dest. Raises IOError if the filesystem
+    can't (e.g., dest is on another filesystem)"""
+    fh_source = file(source, "rb")
+    try:
+        fh_dest = file(dest, "wb")
+        try:
+            fcntl.ioctl(fh_dest.fileno(), FICLONE, fh_source.fileno())
+        except:
+            fh_dest.close()
+            os.remove(dest)
+            raise
+        fh_dest.close()
+    finally:
+        fh_source.close()
+
+def _database_limits(limits):
+    """Rolling back a database drops and recreates it, so a restore limited
+    to some of a database's tables needs a snapshot of the whole database"""
+
+    db_limits = []
+    for limit in limits:
+        if '/' not in limit:
+            db_limits.append(limit)
+        elif not limit.startswith('-'):
+            db_limits.append(limit.split('/')[0])
+
+    return db_limits
+
+class Journal:
+    """Append-only log of completed rollback entries (paths and steps), so
+    an interrupted rollback can resume where it left off"""
+
+    def __init__(self, path):
+        self.done = set()
+        size = 0
+        if exists(path):
+            for line in file(path):
+                # ignore a partially written last line
+                if line.endswith("\n"):
+                    self.done.add(line[:-1])
+                    size += len(line)
+
+        self.fh = file(path, "a")
+
+        # so it isn't joined with the next entry we add
+        self.fh.truncate(size)
+        self.lock = threading.Lock()
+
+    def __contains__(self, entry):
+        return entry in self.done
+
+    def add(self, entry):
+        self.lock.acquire()
+        try:
+            self.done.add(entry)
+            self.fh.write(entry + "\n")
+            self.fh.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.fh.close()
+
 class Rollback:
     Error = Error
 
@@ -38,7 +107,7 @@ class Rollback:
     class Paths(_Paths):
         files = [ 'etc', 'etc/mysql',
                   'fsdelta', 'dirindex', 'originals',
-                  'newpkgs', 'myfs', 'pgfs' ]
+                  'newpkgs', 'myfs', 'pgfs', 'journal' ]
 
     @classmethod
     def create(cls, path=PATH):
@@ -67,62 +136,143 @@ class Rollback:
         if not lexists(source):
             raise Error("no such file or directory " + `source`)
 
-        if not exists(dirname(dest)):
-            os.makedirs(dirname(dest))
+        mkdir(dirname(dest))
+
+        # a rename on the same filesystem replaces dest in one step
+        if not isdir(dest) or islink(dest):
+            try:
+                os.rename(source, dest)
+                return
+            except OSError:
+                pass
 
         utils.remove_any(dest)
-        utils.move(source, dest)
+        if islink(source) or not isdir(source):
+            Rollback._snapshot(source, dest)
+            os.remove(source)
+        else:
+            utils.move(source, dest)
 
-    def _move_to_originals(self, source):
-        """Move source into originals"""
+    @staticmethod
+    def _snapshot(source, dest):
+        """Preserve a copy of source at dest, leaving source in place.
+
+        Regular files are hardlinked on the same device, otherwise cloned
+        where the filesystem supports it and only copied as a last resort.
+        A hardlinked original is safe because the overlay replaces files
+        rather than writing into them (tar unlinks before extracting) and
+        rollback restores ownership and permissions from the dirindex."""
+
+        st = os.lstat(source)
+
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source), dest)
+        else:
+            if st.st_dev == os.stat(dirname(dest)).st_dev:
+                os.link(source, dest)
+                return
+
+            if not stat.S_ISREG(st.st_mode):
+                os.mknod(dest, st.st_mode, st.st_rdev)
+            else:
+                try:
+                    _reflink(source, dest)
+                except IOError:
+                    shutil.copyfile(source, dest)
+
+            shutil.copystat(source, dest)
+
+        os.lchown(dest, st.st_uid, st.st_gid)
+
+    def _snapshot_to_originals(self, source):
+        """Snapshot source into originals, or move it if it's a directory"""
         dest = join(self.paths.originals, source.strip('/'))
-        self._move(source, dest)
+        mkdir(dirname(dest))
+
+        if not islink(source) and isdir(source):
+            self._move(source, dest)
+        else:
+            utils.remove_any(dest)
+            self._snapshot(source, dest)
 
     def _move_from_originals(self, dest):
         """Move path from originals to dest"""
         source = join(self.paths.originals, dest.strip('/'))
         self._move(source, dest)
 
-    def rollback_files(self):
-        if not exists(self.paths.fsdelta):
+    def _rollback_change(self, path, op, dirindex):
+        if path not in dirindex:
+            utils.remove_any(path)
             return
 
-        changes = Changes.fromfile(self.paths.fsdelta)
-        dirindex = DirIndex(self.paths.dirindex)
-
-        exceptions = 0
-        for change in changes:
+        if op in ('o', 'd'):
             try:
-                if change.path not in dirindex:
-                    utils.remove_any(change.path)
-                    continue
+                self._move_from_originals(path)
+            except self.Error:
+                # moved back by an interrupted rollback, which may not have
+                # fixed its ownership and permissions yet
+                if not lexists(path):
+                    return
 
-                if change.OP in ('o', 'd'):
-                    try:
-                        self._move_from_originals(change.path)
-                    except self.Error:
-                        continue
+        dirindex_rec = dirindex[path]
+        st = os.lstat(path)
+
+        if dirindex_rec.uid != st.st_uid or \
+           dirindex_rec.gid != st.st_gid:
+            os.lchown(path, dirindex_rec.uid, dirindex_rec.gid)
 
-                dirindex_rec = dirindex[change.path]
-                local_rec = DirIndex.Record.frompath(change.path)
+        if dirindex_rec.mod != st.st_mode:
+            mod = stat.S_IMODE(dirindex_rec.mod)
+            os.chmod(path, mod)
 
-                if dirindex_rec.uid != local_rec.uid or \
-                   dirindex_rec.gid != local_rec.gid:
-                    os.lchown(change.path, dirindex_rec.uid, dirindex_rec.gid)
+    def rollback_files(self, workers=APPLY_WORKERS, journal=None):
+        """Roll back changed files, skipping paths already in journal (and
+        adding the paths we roll back to it).
 
-                if dirindex_rec.mod != local_rec.mod:
-                    mod = stat.S_IMODE(dirindex_rec.mod)
-                    os.chmod(change.path, mod)
+        A path only depends on its parent directories (e.g., a directory
+        moved back whole), so paths at the same depth are independent and
+        are rolled back in parallel, one depth at a time."""
+
+        if not exists(self.paths.fsdelta):
+            return
+
+        dirindex = DirIndex.load(self.paths.dirindex)
+
+        depths = {}
+        for change in ChangesFile(self.paths.fsdelta):
+            if journal and change.path in journal:
+                continue
+
+            depths.setdefault(change.path.count('/'), []).append(change)
+
+        lock = threading.Lock()
+        exceptions = []
+
+        def rollback_change(path, op):
+            try:
+                self._rollback_change(path, op, dirindex)
             except:
-                exceptions += 1
                 # fault-tolerance: warn and continue, don't die
-                traceback.print_exc(file=sys.stderr)
+                lock.acquire()
+                try:
+                    exceptions.append(path)
+                    traceback.print_exc(file=sys.stderr)
+                finally:
+                    lock.release()
+                return
+
+            if journal:
+                journal.add(path)
+
+        for depth in sorted(depths):
+            apply_actions([ Changes.Action(rollback_change, change.path, change.OP)
+                            for change in depths[depth] ], workers)
 
         for fname in ('passwd', 'group'):
             shutil.copy(join(self.paths.etc, fname), "/etc")
 
         if exceptions:
-            raise Error("caught %d exceptions during rollback_files" % exceptions)
+            raise Error("caught %d exceptions during rollback_files" % len(exceptions))
 
     def rollback_new_packages(self):
         if not exists(self.paths.newpkgs):
@@ -143,25 +293,40 @@ class Rollback:
         if exists(self.paths.pgfs):
             pgsql.restore(self.paths.pgfs)
 
-    def rollback(self):
+    def rollback(self, workers=APPLY_WORKERS):
+        """Roll back the last restore. Completed steps and files are
+        journaled, so if we're interrupted or fail, running rollback again
+        resumes where we left off. The rollback is deleted once it succeeds"""
+
+        journal = Journal(self.paths.journal)
+
         exceptions = 0
-        for method in (self.rollback_database, self.rollback_files, self.rollback_new_packages):
+        for method, args in ((self.rollback_database, ()),
+                             (self.rollback_files, (workers, journal)),
+                             (self.rollback_new_packages, ())):
+            if method.__name__ in journal:
+                continue
+
             try:
-                method()
+                method(*args)
+                journal.add(method.__name__)
             except:
                 exceptions += 1
                 print >> sys.stderr, "error: %s raised an exception:" % method.__name__
                 traceback.print_exc(file=sys.stderr)
 
-        shutil.rmtree(self.paths)
+        journal.close()
+
         if exceptions:
-            raise Error("caught %d exceptions during rollback" % exceptions)
+            raise Error("caught %d exceptions during rollback (run again to retry)" % exceptions)
+
+        shutil.rmtree(self.paths)
 
     def save_files(self, changes, overlay_path):
         for fname in ("passwd", "group"):
             shutil.copy(join("/etc", fname), self.paths.etc)
 
-        changes.tofile(self.paths.fsdelta)
+        changes.tofile(self.paths.fsdelta, packed=True)
         di = DirIndex()
         for change in changes:
             if lexists(change.path):
@@ -169,8 +334,14 @@ class Rollback:
                 if change.OP in ('o', 'd'):
                     if change.OP == 'o' and not lexists(overlay_path + change.path):
                         continue
-                    self._move_to_originals(change.path)
-        di.save(self.paths.dirindex)
+
+                    # directories are moved whole, so we index what's beneath
+                    # them too or rolling back would remove it as new
+                    if not islink(change.path) and isdir(change.path):
+                        di.walk(change.path)
+
+                    self._snapshot_to_originals(change.path)
+        di.save(self.paths.dirindex, binary=True)
 
     def save_new_packages(self, packages):
         packages = list(packages)
@@ -181,14 +352,20 @@ class Rollback:
             print >> fh, package
         fh.close()
 
-    def save_database(self):
-        try:
-            mysql.backup(self.paths.myfs, self.paths.etc.mysql)
-        except mysql.Error:
-            pass
+    def save_database(self, mydb_limits=[], pgdb_limits=[], skip_mysql=False, skip_pgsql=False):
+        """Snapshot the databases that a restore limited to mydb_limits and
+        pgdb_limits will change. Skipped engines aren't snapshotted"""
 
-        try:
-            pgsql.backup(self.paths.pgfs)
-        except pgsql.Error:
-            pass
+        if not skip_mysql:
+            try:
+                mysql.backup(self.paths.myfs, self.paths.etc.mysql,
+                             limits=_database_limits(mydb_limits))
+            except mysql.Error:
+                pass
+
+        if not skip_pgsql:
+            try:
+                pgsql.backup(self.paths.pgfs, _database_limits(pgdb_limits))
+            except pgsql.Error:
+                pass
 
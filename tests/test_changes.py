@@ -0,0 +1,128 @@
+#!/usr/bin/python
+"""
+Unit tests for changes
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os
+from os.path import *
+
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import userdb
+import changes
+from changes import Changes, IdNames, apply_actions, iterchanges, iterolist
+from dirindex import DirIndex
+
+class TestApplyActions(unittest.TestCase):
+    def actions(self, paths, slow=()):
+        self.applied = []
+        def apply(path):
+            if path in slow:
+                time.sleep(0.05)
+            self.applied.append(path)
+
+        return [ Changes.Action(apply, path) for path in paths ]
+
+    def test_parents_before_children(self):
+        paths = [ "/a", "/b", "/a/x", "/a/y", "/b/x", "/a/x/1" ]
+        apply_actions(self.actions(paths, slow=("/a", "/a/x")), 4)
+
+        self.assertEquals(sorted(self.applied), sorted(paths))
+        for path in paths:
+            if dirname(path) in paths:
+                self.assert_(self.applied.index(dirname(path)) < self.applied.index(path))
+
+    def test_children_before_parents(self):
+        paths = [ "/a/x/1", "/a/x", "/a/y", "/a" ]
+        apply_actions(self.actions(paths, slow=("/a/x/1", "/a/y")), 4)
+
+        self.assertEquals(self.applied.index("/a"), len(paths) - 1)
+        self.assert_(self.applied.index("/a/x/1") < self.applied.index("/a/x"))
+
+    def test_unordered_dont_wait(self):
+        paths = [ "/a", "/a/x", "/b", "/b/y" ]
+        actions = self.actions(paths, slow=("/a",))
+
+        # e.g., chmod /a doesn't need to finish before chmod /a/x
+        unordered = changes._UNORDERED
+        changes._UNORDERED = unordered + (actions[0].func,)
+        try:
+            apply_actions(actions, 4)
+        finally:
+            changes._UNORDERED = unordered
+
+        self.assertEquals(sorted(self.applied), sorted(paths))
+        self.assertEquals(self.applied[-1], "/a")
+
+    def test_first_error_raised(self):
+        def fail(path):
+            raise OSError(path)
+
+        actions = self.actions([ "/a", "/b" ]) + [ Changes.Action(fail, "/c") ]
+        self.assertRaises(OSError, apply_actions, actions, 4)
+
+class TestIterolist(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_changes-")
+        self.root = join(self.tmpdir, "root")
+
+        for path in ("a-b/x", "c/x"):
+            self.write(path)
+
+        di = DirIndex()
+        di.walk(self.root)
+        self.index = join(self.tmpdir, "index")
+        di.save(self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path):
+        path = join(self.root, path)
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+
+        file(path, "w").write(path)
+
+        # saved indexes only keep whole seconds
+        os.utime(path, (1000000000, 1000000000))
+
+    def olist(self, *paths):
+        paths = [ self.root ] + [ "-" + join(self.root, path) for path in paths ]
+        return [ path[len(self.root) + 1:]
+                 for path in iterolist(iterchanges(self.index, paths), self.index, paths) ]
+
+    def test_collapsed(self):
+        for path in ("a/x", "a/y/z", "a-b/y", "c/d/x", "c/y"):
+            self.write(path)
+
+        # a sorts before a-b, though it is decided by a/x, which comes after
+        self.assertEquals(self.olist(), [ "a", "a-b/y", "c/d", "c/y" ])
+
+    def test_excluded_beneath(self):
+        for path in ("a/x", "a/y/z"):
+            self.write(path)
+
+        self.assertEquals(self.olist("a/y/z"), [ "a/x" ])
+
+class TestIdNames(unittest.TestCase):
+    def test_nis_compat_entries(self):
+        passwd = userdb.EtcPasswd("root:x:0:0:root:/root:/bin/bash\n"
+                                  "+::::::\n"
+                                  "bob:x:1000:1000::/home/bob:/bin/sh\n")
+        group = userdb.EtcGroup("root:x:0:\n"
+                                "+:::\n")
+
+        names = IdNames(passwd, group)
+        self.assertEquals(names.uid(1000), "bob")
+        self.assertEquals(names.gid(0), "root")
+
+if __name__ == "__main__":
+    unittest.main()
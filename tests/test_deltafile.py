@@ -0,0 +1,65 @@
+#!/usr/bin/python
+"""
+Unit tests for deltafile
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+from os.path import *
+
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import deltafile
+
+class TestDeltafile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_deltafile-")
+        self.path = join(self.tmpdir, "delta")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        lines = [ "o\t/etc/hostname\t0\t0\n",
+                  "o\t/etc/hosts\t0\t0\n",
+                  "s\t/etc/hosts.d\t0\t0\t41ed\n",
+                  "d\t/var\n" ]
+
+        deltafile.write(self.path, lines, 1)
+        self.assertEquals(list(deltafile.iterlines(self.path, 1)), lines)
+
+        # shared prefixes are packed
+        self.assertEquals(file(self.path, "rb").read(2), deltafile.GZIP_MAGIC)
+
+    def test_roundtrip_large(self):
+        # more lines than we buffer, more data than we read at once
+        lines = [ "/var/lib/%08d/%s\n" % (i, "x" * (i % 50)) for i in range(20000) ]
+
+        deltafile.write(self.path, lines)
+        self.assertEquals(list(deltafile.iterlines(self.path)), lines)
+
+    def test_plain_text(self):
+        lines = [ "/etc/hostname\n", "/etc/hosts" ]
+        file(self.path, "w").writelines(lines)
+
+        self.assertEquals(list(deltafile.iterlines(self.path)), lines)
+
+    def test_empty(self):
+        deltafile.write(self.path, [])
+        self.assertEquals(list(deltafile.iterlines(self.path)), [])
+
+    def test_bad_version(self):
+        deltafile.write(self.path, [ "/etc\n" ])
+        version = deltafile.VERSION
+        try:
+            deltafile.VERSION = version + 1
+            self.assertRaises(deltafile.Error, list, deltafile.iterlines(self.path))
+        finally:
+            deltafile.VERSION = version
+
+if __name__ == "__main__":
+    unittest.main()
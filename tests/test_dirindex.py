@@ -0,0 +1,291 @@
+#!/usr/bin/python
+"""
+Unit tests for dirindex
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os
+from os.path import *
+
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import dirindex
+from dirindex import DirIndex
+
+class DirIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_dirindex-")
+        self.root = join(self.tmpdir, "root")
+
+        for path in ("a/x", "a/y", "a-b/z", "b/c/d", "e"):
+            self.write(path, path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        path = join(self.root, path)
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+
+        file(path, "w").write(content)
+
+        # saved indexes only keep whole seconds
+        os.utime(path, (1000000000, 1000000000))
+
+    def index(self, name="index", binary=False):
+        di = DirIndex()
+        di.walk(self.root)
+
+        path = join(self.tmpdir, name)
+        di.save(path, binary)
+        return path
+
+    def diff(self, index):
+        current = dirindex.iterwalk(self.root)
+        return [ (change, rec.path[len(self.root):])
+                 for change, rec in dirindex.iterdiff(dirindex.iterload(index), current,
+                                                      [ self.root ]) ]
+
+class TestWalk(DirIndexTestCase):
+    def test_walk(self):
+        os.symlink("a/x", join(self.root, "link"))
+
+        lstats = []
+        def lstat(path):
+            lstats.append(path)
+            return self.lstat(path)
+
+        self.lstat = os.lstat
+        os.lstat = lstat
+        try:
+            di = DirIndex()
+            di.walk(self.root, "-" + join(self.root, "b"))
+        finally:
+            os.lstat = self.lstat
+
+        paths = [ self.root ] + [ join(self.root, path)
+                                  for path in ("a", "a/x", "a/y", "a-b", "a-b/z", "e", "link") ]
+        self.assertEquals(sorted(di), sorted(paths))
+
+        for path in paths:
+            self.assertEquals(di[path].fmt(), DirIndex.Record.frompath(path).fmt())
+
+        # every entry is stat'ed once (or not at all with scandir), excluded
+        # entries never are
+        self.assertEquals(len(lstats), len(set(lstats)))
+        self.assert_(join(self.root, "b/c") not in lstats)
+
+    def test_walk_globs(self):
+        for path in ("a/x.conf", "b/c/x.conf", "b/c/.x.conf"):
+            self.write(path, path)
+
+        paths = [ join(self.root, "*/x*"), join(self.root, "**/*.conf"),
+                  "-" + join(self.root, "b/c/d"), "-" + join(self.root, "a-b") ]
+
+        di = DirIndex()
+        di.walk(*paths)
+
+        expected = [ join(self.root, path)
+                     for path in ("a/x", "a/x.conf", "b/c/x.conf") ]
+        self.assertEquals(sorted(di), expected)
+
+        self.assertEquals([ rec.path for rec in dirindex.iterwalk(*paths) ], expected)
+        self.assertEquals([ rec.path for rec in dirindex.iterwalk(*paths, workers=2) ], expected)
+
+class TestIterdiff(DirIndexTestCase):
+    def test_changes(self):
+        index = self.index()
+
+        os.remove(join(self.root, "a/y"))
+        self.write("a/x", "edited")
+        self.write("a-b/new", "new")
+        os.chmod(join(self.root, "e"), 0600)
+
+        # in path order ('-' sorts before '/')
+        self.assertEquals(self.diff(index), [ ('new', '/a-b/new'),
+                                              ('edited', '/a/x'),
+                                              ('deleted', '/a/y'),
+                                              ('stat', '/e') ])
+
+    def test_unchanged(self):
+        self.assertEquals(self.diff(self.index()), [])
+        self.assertEquals(self.diff(self.index(binary=True)), [])
+
+    def test_unsorted_index(self):
+        index = self.index()
+
+        # indexes saved by older versions are in dict order
+        lines = file(index).readlines()
+        random.seed(0)
+        random.shuffle(lines)
+        file(index, "w").writelines(lines)
+
+        paths = [ rec.path for rec in dirindex.iterload(index) ]
+        self.assertEquals(paths, sorted(paths))
+
+        os.remove(join(self.root, "a/y"))
+        self.assertEquals(self.diff(index), [ ('deleted', '/a/y') ])
+
+class TestMappedDirIndex(DirIndexTestCase):
+    def setUp(self):
+        DirIndexTestCase.setUp(self)
+
+        # enough records for several restarts
+        self.di = DirIndex()
+        for i in range(100):
+            for path in ("/srv/%02d" % i, "/srv/%02d/file" % i, "/srv/%02d-old" % i):
+                self.di[path] = DirIndex.Record(path, 0100644, 0, 0, i, 1000000000 + i,
+                                                digest="%040x" % i if i % 2 else None)
+
+        self.path = join(self.tmpdir, "binary")
+        self.di.save(self.path, binary=True)
+        self.mapped = dirindex.MappedDirIndex(self.path)
+
+    def test_records(self):
+        self.assert_(dirindex.MappedDirIndex.is_binary(self.path))
+        self.assertEquals(len(self.mapped), len(self.di))
+        self.assertEquals(list(self.mapped), sorted(self.di))
+
+        for rec in self.mapped.records():
+            self.assertEquals(rec.fmt(), self.di[rec.path].fmt())
+
+    def test_lookups(self):
+        for path in sorted(self.di):
+            self.assert_(path in self.mapped)
+            self.assertEquals(self.mapped[path].size, self.di[path].size)
+
+        for path in ("/", "/srv", "/srv/00/fil", "/srv/99/file/x", "/zzz"):
+            self.assert_(path not in self.mapped)
+        self.assertRaises(KeyError, self.mapped.__getitem__, "/srv/100")
+
+    def test_subtree(self):
+        self.assertEquals([ rec.path for rec in self.mapped.subtree("/srv/42") ],
+                          [ "/srv/42", "/srv/42/file" ])
+
+        self.assertEquals([ rec.path for rec in self.mapped.iterprefix("/srv/9") ],
+                          sorted([ path for path in self.di if path.startswith("/srv/9") ]))
+
+    def test_iterload(self):
+        self.assertEquals([ rec.path for rec in dirindex.iterload(self.path) ],
+                          sorted(self.di))
+
+class TestHashCache(DirIndexTestCase):
+    def setUp(self):
+        DirIndexTestCase.setUp(self)
+        self.cache = join(self.tmpdir, "hashcache")
+
+        self.digested = []
+        def file_digest(path):
+            self.digested.append(path)
+            return self.file_digest(path)
+
+        self.file_digest = dirindex.file_digest
+        dirindex.file_digest = file_digest
+
+    def tearDown(self):
+        dirindex.file_digest = self.file_digest
+        DirIndexTestCase.tearDown(self)
+
+    def test_cached(self):
+        path = join(self.root, "a/x")
+
+        cache = dirindex.HashCache(self.cache)
+        digest = cache.digest(path)
+        cache.save()
+
+        cache = dirindex.HashCache(self.cache)
+        self.assertEquals(cache.digest(path), digest)
+        self.assertEquals(self.digested, [ path ])
+
+        # a changed file is read again
+        self.write("a/x", "changed")
+        self.assertNotEquals(cache.digest(path), digest)
+        self.assertEquals(self.digested, [ path, path ])
+
+    def test_racy_not_saved(self):
+        path = join(self.root, "a/x")
+        os.utime(path, None)
+
+        cache = dirindex.HashCache(self.cache)
+        cache.digest(path)
+        cache.save()
+
+        dirindex.HashCache(self.cache).digest(path)
+        self.assertEquals(self.digested, [ path, path ])
+
+class TestDirCache(DirIndexTestCase):
+    def setUp(self):
+        DirIndexTestCase.setUp(self)
+        self.cache = join(self.tmpdir, "dircache")
+
+        # directories that were last changed long ago
+        for dir in ("", "a", "a-b", "b", "b/c"):
+            os.utime(join(self.root, dir), (1000000000, 1000000000))
+
+        self.listed = []
+        def listdir(path):
+            self.listed.append(path)
+            return self.listdir(path)
+
+        self.listdir = os.listdir
+        os.listdir = listdir
+
+    def tearDown(self):
+        os.listdir = self.listdir
+        DirIndexTestCase.tearDown(self)
+
+    def walk(self, key="key"):
+        cache = dirindex.DirCache(self.cache, key)
+
+        # their ctimes are now, pretend they aren't racy
+        cache.started += 60
+
+        del self.listed[:]
+        recs = [ rec.fmt() for rec in dirindex.iterwalk(self.root, cache=cache) ]
+        cache.save()
+
+        return recs
+
+    def test_cached(self):
+        recs = self.walk()
+        self.assertEquals(len(self.listed), 5)
+
+        self.assertEquals(self.walk(), recs)
+        self.assertEquals(self.listed, [])
+
+        # a new file changes its directory's mtime
+        self.write("a/new", "new")
+        self.assertEquals(len(self.walk()), len(recs) + 1)
+        self.assertEquals(self.listed, [ join(self.root, "a") ])
+
+    def test_other_key(self):
+        self.walk()
+        self.walk("other")
+        self.assertEquals(len(self.listed), 5)
+
+    def test_stale_listing(self):
+        recs = self.walk()
+
+        # a saved listing with an entry that no longer exists
+        cache = dirindex.DirCache(self.cache, "key")
+        cache.listings = cache.cached
+        validator, names = cache.listings[join(self.root, "a")]
+        cache.listings[join(self.root, "a")] = (validator, names + "\0gone")
+        cache.save()
+
+        self.assertEquals(self.walk(), recs)
+
+        # and isn't saved again
+        cache = dirindex.DirCache(self.cache, "key")
+        self.assert_(join(self.root, "a") not in cache.cached)
+        self.assert_(join(self.root, "b") in cache.cached)
+
+if __name__ == "__main__":
+    unittest.main()
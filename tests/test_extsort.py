@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+Unit tests for extsort
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os
+from os.path import *
+
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import extsort
+
+class TestIterSorted(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_extsort-")
+
+        random.seed(0)
+        self.items = [ ("/path/%d" % random.randint(0, 1000), i) for i in range(1000) ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_in_memory(self):
+        self.assertEquals(list(extsort.iter_sorted(self.items, self.tmpdir)),
+                          sorted(self.items))
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def test_spilled_runs(self):
+        sorted_items = extsort.iter_sorted(iter(self.items), self.tmpdir, run_size=64)
+        self.assertEquals(list(sorted_items), sorted(self.items))
+
+        # runs are unlinked as soon as they're opened for the merge
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def test_fan_in(self):
+        loaded = []
+        open_runs = []
+        def load(fh):
+            loaded.append(fh)
+            open_runs.append(fh)
+            self.peak = max(self.peak, len(open_runs))
+
+            for item in self.load(fh):
+                yield item
+            open_runs.remove(fh)
+
+        self.peak = 0
+        self.load = extsort._load
+        extsort._load = load
+        try:
+            sorted_items = extsort.iter_sorted(iter(self.items), self.tmpdir,
+                                               run_size=8, fan_in=4)
+            self.assertEquals(list(sorted_items), sorted(self.items))
+        finally:
+            extsort._load = self.load
+
+        # 125 runs, but no more than 4 were open at a time
+        self.assert_(len(loaded) > 125)
+        self.assertEquals(self.peak, 4)
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def test_empty(self):
+        self.assertEquals(list(extsort.iter_sorted([], self.tmpdir, run_size=1)), [])
+
+    def test_error_removes_runs(self):
+        def items():
+            for item in self.items[:200]:
+                yield item
+            raise ValueError("scan failed")
+
+        self.assertRaises(ValueError, extsort.iter_sorted, items(), self.tmpdir, 64)
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,457 @@
+#!/usr/bin/python
+"""
+Unit tests for mysql (no MySQL server needed)
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os
+from os.path import *
+
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import mysql
+
+SQL = """\
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `db` /*!40100 DEFAULT CHARACTER SET latin1 */;
+USE `db`;
+CREATE TABLE `small` (
+  `id` int(11) NOT NULL,
+  `name` varchar(10) default NULL
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `small` VALUES (1,'a');
+INSERT INTO `small` VALUES (2,NULL);
+CREATE TABLE `big` (
+  `id` int(11) NOT NULL,
+  `text` text
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `big` VALUES (1,'semi;colon');
+INSERT INTO `big` VALUES (2,'tab\\there');
+INSERT INTO `big` VALUES (3,'it\\'s');
+INSERT INTO `big` VALUES (4,'');
+CREATE TABLE `empty` (
+  `id` int(11) NOT NULL
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+"""
+
+def statements(s):
+    return list(mysql._parse_statements(StringIO(s)))
+
+class Connection(StringIO):
+    def close(self):
+        self.text = self.getvalue()
+        StringIO.close(self)
+
+class MyFSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_mysql-")
+        self.myfs = join(self.tmpdir, "myfs")
+        os.mkdir(self.myfs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def mysql2fs(self, sql=SQL, **kws):
+        writer = mysql.MyFS_Writer(self.myfs, **kws)
+        writer.fromfile(StringIO(sql))
+        del writer
+
+        # rows files are closed when their tables are
+        import gc
+        gc.collect()
+
+class TestConnect(MyFSTestCase):
+    def setUp(self):
+        MyFSTestCase.setUp(self)
+
+        self.commands = []
+
+        class Popen:
+            def __init__(popen, command, **kws):
+                self.commands.append(command)
+                popen.stdin = StringIO()
+                popen.returncode = 0
+
+            def wait(popen):
+                return 0
+
+        def popen(command, mode):
+            self.commands.append(command)
+            return StringIO()
+
+        self.saved = (mysql.Popen, os.popen, mysql.PATH_DEBIAN_CNF)
+
+        mysql.Popen = Popen
+        os.popen = popen
+        mysql.PATH_DEBIAN_CNF = join(self.tmpdir, "debian.cnf")
+        file(mysql.PATH_DEBIAN_CNF, "w").close()
+
+    def tearDown(self):
+        mysql.Popen, os.popen, mysql.PATH_DEBIAN_CNF = self.saved
+        MyFSTestCase.tearDown(self)
+
+    def test_mysql_options_dont_accumulate(self):
+        mysql.mysql(local_infile="1")
+        mysql.mysql(local_infile="1")
+
+        self.assertEquals(len(set(self.commands)), 1)
+        self.assertEquals(self.commands[0],
+                          "mysql --defaults-file=%s --local-infile=1" % mysql.PATH_DEBIAN_CNF)
+
+    def test_opts_list_unchanged(self):
+        opts = [ "batch" ]
+        mysql._mysql_opts(opts, user="root")
+        self.assertEquals(opts, [ "batch" ])
+
+# stands in for the mysql client: answers the lock handshake (if its output
+# is unbuffered) and holds the lock until stdin is closed
+FAKE_MYSQL = """#!/bin/sh
+case "$*" in *--unbuffered*) ;; *) exec sleep 60 ;; esac
+read query
+[ -n "$HANG" ] && exec sleep 60
+echo locked
+cat > /dev/null
+echo unlocked > "$0.log"
+"""
+
+class TestGlobalReadLock(MyFSTestCase):
+    def setUp(self):
+        MyFSTestCase.setUp(self)
+
+        self.mysql = join(self.tmpdir, "mysql")
+        file(self.mysql, "w").write(FAKE_MYSQL)
+        os.chmod(self.mysql, 0755)
+
+        self.saved = (os.environ.copy(), mysql.PATH_DEBIAN_CNF)
+        os.environ['PATH'] = self.tmpdir + ":" + os.environ['PATH']
+        mysql.PATH_DEBIAN_CNF = join(self.tmpdir, "debian.cnf")
+
+    def tearDown(self):
+        environ, mysql.PATH_DEBIAN_CNF = self.saved
+        os.environ.clear()
+        os.environ.update(environ)
+        MyFSTestCase.tearDown(self)
+
+    def test_lock(self):
+        lock = mysql.GlobalReadLock(timeout=10)
+        self.assert_(not exists(self.mysql + ".log"))
+
+        lock.release()
+        self.assertEquals(file(self.mysql + ".log").read(), "unlocked\n")
+
+    def test_timeout(self):
+        os.environ['HANG'] = "1"
+        self.assertRaises(mysql.Error, mysql.GlobalReadLock, timeout=1)
+
+class TestParseStatements(unittest.TestCase):
+    def test_statements(self):
+        self.assertEquals(statements(SQL)[:4], [
+            "CREATE DATABASE /*!32312 IF NOT EXISTS*/ `db` /*!40100 DEFAULT CHARACTER SET latin1 */;",
+            "USE `db`;",
+            "CREATE TABLE `small` (\n  `id` int(11) NOT NULL,\n  `name` varchar(10) default NULL\n"
+            ") ENGINE=MyISAM DEFAULT CHARSET=utf8;",
+            "INSERT INTO `small` VALUES (1,'a');" ])
+
+    def test_quotes(self):
+        sql = ("INSERT INTO `t` VALUES ('semi;\n"
+               "-- not a comment;\n"
+               "');\n"
+               "INSERT INTO `t` VALUES ('it\\'s;'),('x''y;');\n"
+               "SELECT \"a;\";\n")
+
+        self.assertEquals(statements(sql), [
+            "INSERT INTO `t` VALUES ('semi;\n-- not a comment;\n');",
+            "INSERT INTO `t` VALUES ('it\\'s;'),('x''y;');",
+            "SELECT \"a;\";" ])
+
+    def test_comments_and_delimiters(self):
+        sql = ("-- MySQL dump\n"
+               "\n"
+               "DELIMITER ;;\n"
+               "/*!50003 CREATE TRIGGER `tr` BEFORE INSERT ON `t` FOR EACH ROW BEGIN\n"
+               "SET @a = 1;\n"
+               "END */;;\n"
+               "DELIMITER ;\n"
+               "/*!50003 SET @x = 1 */;\n")
+
+        self.assertEquals(statements(sql), [
+            "/*!50003 CREATE TRIGGER `tr` BEFORE INSERT ON `t` FOR EACH ROW BEGIN\n"
+            "SET @a = 1;\nEND */;;",
+            "/*!50003 SET @x = 1 */;" ])
+
+class TestTofiles(MyFSTestCase):
+    def test_failed_connect(self):
+        self.mysql2fs()
+
+        connections = []
+        def connect():
+            if len(connections) == 1:
+                raise mysql.Error("can't connect")
+
+            connections.append(Connection())
+            return connections[-1]
+
+        reader = mysql.MyFS_Reader(self.myfs)
+        self.assertRaises(mysql.Error, reader.tofiles, connect, 2)
+
+    def test_rows_loaded_once(self):
+        self.mysql2fs()
+
+        connections = []
+        def connect():
+            connections.append(Connection())
+            return connections[-1]
+
+        serial = StringIO()
+        mysql.MyFS_Reader(self.myfs).tofile(serial)
+        mysql.MyFS_Reader(self.myfs).tofiles(connect, 2)
+
+        def inserts(text):
+            return sorted([ s for s in statements(text) if s.startswith("INSERT") ])
+
+        self.assertEquals(inserts("".join([ c.text for c in connections ])),
+                          inserts(serial.getvalue()))
+
+        # schema first, triggers and views last, both without rows
+        self.assertEquals(inserts(connections[0].text), [])
+        self.assertEquals(inserts(connections[-1].text), [])
+
+class TestDumpGroups(unittest.TestCase):
+    sizes = { ('a', 'big'): 100, ('a', 'small'): 10, ('a', 'other'): 10,
+              ('b', 'x'): 20, ('c', 'y'): 5 }
+
+    def groups(self, tables, workers):
+        groups = mysql._dump_groups(tables, self.sizes, workers)
+        return [ mysql._dump_args(dumps, self.sizes) for dumps in groups ]
+
+    def test_one_dump_per_worker(self):
+        tables = sorted(self.sizes)
+        for workers in (1, 2, 3, 10):
+            groups = self.groups(tables, workers)
+            self.assert_(len(groups) <= workers)
+
+            dumped = []
+            for args in groups:
+                ignored = [ tuple(arg.split("=")[1].split(".")) for arg in args
+                            if arg.startswith("--ignore-table=") ]
+                databases = [ arg for arg in args if not arg.startswith("--") ]
+                dumped += [ (db, table) for db, table in tables
+                            if db in databases and (db, table) not in ignored ]
+
+            self.assertEquals(sorted(dumped), tables)
+
+    def test_excluded_tables_ignored(self):
+        groups = self.groups([ ('a', 'big'), ('b', 'x') ], 1)
+        self.assertEquals(len(groups), 1)
+        self.assertEquals(sorted(groups[0]), [ "--ignore-table=a.other",
+                                               "--ignore-table=a.small", "a", "b" ])
+
+class TestFingerprint(MyFSTestCase):
+    def setUp(self):
+        MyFSTestCase.setUp(self)
+        self.init = join(self.tmpdir, "init")
+        file(self.init, "w").write("CREATE TABLE `t` (`id` int(11))")
+
+    def test_fingerprint(self):
+        a = mysql._fingerprint(self.init, "InnoDB", "", "1000", "2000")
+        self.assert_(a)
+        self.assertEquals(a, mysql._fingerprint(self.init, "InnoDB", "", "1000", "2000"))
+        self.assertNotEquals(a, mysql._fingerprint(self.init, "InnoDB", "", "1001", "2000"))
+
+        file(self.init, "w").write("CREATE TABLE `t` (`id` bigint(20))")
+        self.assertNotEquals(a, mysql._fingerprint(self.init, "InnoDB", "", "1000", "2000"))
+
+    def test_unreliable(self):
+        # no UPDATE_TIME (e.g., InnoDB after a restart)
+        self.assertEquals(mysql._fingerprint(self.init, "InnoDB", "", "NULL", "2000"), None)
+
+        # updated in the current second
+        self.assertEquals(mysql._fingerprint(self.init, "MyISAM", "", "2000", "2000"), None)
+
+        self.assertEquals(mysql._fingerprint(self.init, "MEMORY", "", "1000", "2000"), None)
+        self.assertEquals(mysql._fingerprint(self.init, "InnoDB", "partitioned", "1000", "2000"), None)
+
+class TestRowsCache(MyFSTestCase):
+    def setUp(self):
+        MyFSTestCase.setUp(self)
+        self.cache = join(self.tmpdir, "cache")
+
+    def rows(self, name, content):
+        path = join(self.tmpdir, name)
+        file(path, "w").write(content)
+        return path
+
+    def test_hit_and_miss(self):
+        cache = mysql.RowsCache(self.cache)
+        cache.put("db", "t", "fp1", self.rows("dumped", "1,'a'\n"))
+        cache.save()
+
+        dest = self.rows("dest", "")
+
+        cache = mysql.RowsCache(self.cache)
+        self.assertFalse(cache.get("db", "t", "fp2", dest))
+        self.assertFalse(cache.get("db", "t", None, dest))
+        self.assertFalse(cache.get("db", "other", "fp1", dest))
+        self.assertEquals(file(dest).read(), "")
+
+        self.assert_(cache.get("db", "t", "fp1", dest))
+        self.assertEquals(file(dest).read(), "1,'a'\n")
+
+    def test_no_fingerprint_uncaches(self):
+        cache = mysql.RowsCache(self.cache)
+        cache.put("db", "t", "fp1", self.rows("dumped", "1\n"))
+        cache.save()
+
+        cache = mysql.RowsCache(self.cache)
+        cache.put("db", "t", None, self.rows("dumped2", "2\n"))
+        cache.save()
+
+        cache = mysql.RowsCache(self.cache)
+        self.assertFalse(cache.get("db", "t", "fp1", self.rows("dest", "")))
+
+    def test_save_drops_missing_tables(self):
+        cache = mysql.RowsCache(self.cache)
+        cache.put("db", "dropped", "fp", self.rows("a", "1\n"))
+        cache.put("db", "excluded", "fp", self.rows("b", "2\n"))
+        cache.save()
+
+        cache = mysql.RowsCache(self.cache)
+        cache.save(existing=[ ("db", "excluded") ])
+
+        cache = mysql.RowsCache(self.cache)
+        self.assertFalse(cache.get("db", "dropped", "fp", self.rows("dest", "")))
+        self.assert_(cache.get("db", "excluded", "fp", self.rows("dest", "")))
+
+    def test_writer_doesnt_write_through(self):
+        self.mysql2fs()
+        rows = mysql.MyFS_Writer(self.myfs).rows_path("db", "small")
+
+        cache = mysql.RowsCache(self.cache)
+        cache.put("db", "small", "fp", rows)
+        cache.save()
+
+        # dumping again truncates rows, which mustn't truncate the cache
+        self.mysql2fs(SQL.replace("INSERT INTO `small`", "-- "))
+
+        cache = mysql.RowsCache(self.cache)
+        dest = self.rows("dest", "")
+        self.assert_(cache.get("db", "small", "fp", dest))
+        self.assertEquals(file(dest).read(), "1,'a'\n2,NULL\n")
+
+LOAD_DATA_ESCAPES = { '0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a' }
+SQL_ESCAPES = dict(LOAD_DATA_ESCAPES.items() + [ ("'", "'"), ('"', '"'), ('\\', '\\') ])
+
+def unescape(s, escapes):
+    out = []
+    i = 0
+    while i < len(s):
+        if s[i] == '\\':
+            out.append(escapes.get(s[i + 1], s[i + 1]))
+            i += 2
+        else:
+            out.append(s[i])
+            i += 1
+
+    return "".join(out)
+
+def load_data_fields(line):
+    """the values LOAD DATA reads from a line"""
+    return [ None if field == '\\N' else unescape(field, LOAD_DATA_ESCAPES)
+             for field in line.split('\t') ]
+
+def sql_fields(values):
+    """the values MySQL reads from the values of an INSERT"""
+    fields = []
+    for m in mysql._VALUE.finditer(values):
+        string, null, number = m.groups()
+        if null:
+            fields.append(None)
+        elif number is not None:
+            fields.append(number)
+        else:
+            fields.append(unescape(string.replace("''", "\\'"), SQL_ESCAPES))
+
+    return fields
+
+class TestTSV(MyFSTestCase):
+    ROWS = [ "1,'a',NULL,-1.5e+20",
+             "2,'tab\there','it\\'s','a''b'",
+             "3,'','\\\\N','new\\nline\\r\\0\\Z'",
+             "4,'\\\\','x\\\\ty'" ]
+
+    def test_tsv_line(self):
+        self.assertEquals(mysql._tsv_line("1,'a',NULL"), "1\ta\t\\N")
+        self.assertEquals(mysql._tsv_line("''"), "")
+
+        for row in self.ROWS:
+            line = mysql._tsv_line(row)
+            self.assertEquals(load_data_fields(line), sql_fields(row))
+
+    def test_tsv_values(self):
+        for row in self.ROWS:
+            values = mysql._tsv_values(mysql._tsv_line(row))
+            self.assertEquals(sql_fields(values), sql_fields(row))
+
+    def test_not_tsv_values(self):
+        for row in ("1,_binary '\\0\xff'", "1,b'101'", "1,0xFF", "1,'a'x", "1,'a"):
+            self.assertEquals(mysql._tsv_line(row), None)
+
+    def test_not_tsv_columns(self):
+        def not_tsv(column):
+            return mysql._NOT_TSV.search("CREATE TABLE `t` (\n  %s,\n  KEY `blob` (`id`)\n)" % column)
+
+        for column in ("`b` bit(1)", "`g` geometry", "`b` blob", "`b` longblob",
+                       "`b` binary(16)", "`b` varbinary(255)"):
+            self.assert_(not_tsv(column), column)
+
+        for column in ("`blob` int(11)", "`s` varchar(10) collate utf8_bin", "`t` text"):
+            self.failIf(not_tsv(column), column)
+
+    def test_fallback_to_sql(self):
+        paths = mysql.MyFS.Table.Paths(self.tmpdir)
+        rows = mysql._RowsFile(paths, True)
+        rows.write("1,'a'")
+        rows.write("2,_binary 'b'")
+        rows.write("3,'c'")
+        rows.close()
+
+        self.failIf(exists(paths.rows_tsv))
+        self.assertEquals([ sql_fields(line) for line in file(paths.rows).read().splitlines() ],
+                          [ [ '1', 'a' ], [ '2', 'b' ], [ '3', 'c' ] ])
+
+    def test_writer_reader(self):
+        sql = SQL + """\
+CREATE TABLE `bin` (
+  `id` int(11) NOT NULL,
+  `data` blob
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+INSERT INTO `bin` VALUES (1,'\\0\xff');
+"""
+        self.mysql2fs(sql, tsv=True)
+
+        writer = mysql.MyFS_Writer(self.myfs)
+        self.assert_(writer.rows_path("db", "big").endswith("rows.tsv"))
+        self.assert_(writer.rows_path("db", "bin").endswith("/rows"))
+
+        fh = StringIO()
+        mysql.MyFS_Reader(self.myfs, load_data=True).tofile(fh)
+
+        loads = [ s for s in statements(fh.getvalue()) if s.startswith("LOAD DATA") ]
+        self.assertEquals(len(loads), 2)
+        self.assert_("INSERT INTO `bin` VALUES \n(1,'\\0\xff');" in fh.getvalue())
+
+        # without LOAD DATA, rows are INSERTed
+        fh = StringIO()
+        mysql.MyFS_Reader(self.myfs, skip_extended_insert=True).tofile(fh)
+
+        inserts = [ s for s in statements(fh.getvalue()) if s.startswith("INSERT INTO `big`") ]
+        self.assertEquals([ sql_fields(mysql._insert_values(s)) for s in inserts ],
+                          [ [ '1', 'semi;colon' ], [ '2', 'tab\there' ], [ '3', "it's" ], [ '4', '' ] ])
+
+if __name__ == "__main__":
+    unittest.main()
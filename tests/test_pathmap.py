@@ -0,0 +1,97 @@
+#!/usr/bin/python
+"""
+Unit tests for pathmap
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+from os.path import *
+
+import sys
+import unittest
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from pathmap import PathMap
+
+class TestPathMap(unittest.TestCase):
+    def test_plain_paths(self):
+        m = PathMap([ '/etc', '-/etc/ssh', '/etc/ssh/ssh_config' ])
+
+        self.assert_('/etc/hosts' in m)
+        self.assert_('/etc/ssh/sshd_config' not in m)
+        self.assert_('/etc/ssh/ssh_config' in m)
+        self.assert_('/usr' not in m)
+
+        self.assert_(m.is_excluded('/etc/ssh'))
+        self.assert_(not m.is_excluded('/etc/ssh/sshd_config'))
+
+    def test_globs(self):
+        m = PathMap([ '/etc', '-/etc/*.bak', '/home/*/public' ])
+
+        self.assert_('/etc/passwd' in m)
+        self.assert_('/etc/passwd.bak' not in m)
+        self.assert_(m.is_excluded('/etc/passwd.bak'))
+
+        self.assert_('/home/bob/public/index.html' in m)
+        self.assert_('/home/bob/private' not in m)
+
+    def test_globstar(self):
+        m = PathMap([ '/var/**/*.log', '-/var/**/.cache' ])
+
+        self.assert_('/var/x.log' in m)
+        self.assert_('/var/log/apache2/error.log' in m)
+        self.assert_('/var/log/apache2/error.txt' not in m)
+
+        self.assert_(m.is_excluded('/var/.cache'))
+        self.assert_(m.is_excluded('/var/lib/app/.cache'))
+
+    def test_hidden(self):
+        m = PathMap([ '/home/*', '/root/.*' ])
+
+        self.assert_('/home/bob' in m)
+        self.assert_('/home/.skel' not in m)
+        self.assert_('/root/.bashrc' in m)
+
+    def test_later_path_wins(self):
+        m = PathMap([ '/etc/*', '-/etc/shadow' ])
+        self.assert_('/etc/shadow' not in m)
+
+        m = PathMap([ '-/etc/shadow', '/etc/*' ])
+        self.assert_('/etc/shadow' in m)
+
+    def test_excluded_beneath(self):
+        m = PathMap([ '/etc', '-/etc/*.bak', '/var', '-/var/**/.cache', '/srv' ])
+
+        self.assert_(m.excluded_beneath('/etc'))
+        self.assert_(m.excluded_beneath('/var/lib/app'))
+        self.assert_(not m.excluded_beneath('/srv'))
+        self.assert_(not m.excluded_beneath('/usr'))
+
+    def test_includes(self):
+        m = PathMap([ '/etc', '/home/*/public', '/var/**/*.log', '/etc/*.conf', '-/etc/ssh' ])
+        self.assertEquals(sorted(m.includes), [ '/etc', '/home', '/var' ])
+
+        m = PathMap([ '/etc/shadow', '-/etc/*' ])
+        self.assertEquals(m.includes, [])
+
+    def test_is_pruned(self):
+        m = PathMap([ '/etc', '-/etc/*.bak', '/home/*/public', '/var/**/*.log',
+                      '/srv', '-/srv/cache', '-/var/cache' ])
+
+        self.assert_(m.is_pruned('/etc/passwd.bak'))
+        self.assert_(not m.is_pruned('/etc/passwd'))
+
+        # leads to a match
+        self.assert_(not m.is_pruned('/home/bob'))
+        self.assert_(not m.is_pruned('/home/bob/public/index.html'))
+        self.assert_(m.is_pruned('/home/bob/private'))
+
+        self.assert_(not m.is_pruned('/var/lib/app'))
+        self.assert_(m.is_pruned('/srv/cache'))
+        self.assert_(m.is_pruned('/usr'))
+
+        # excluded, but *.log beneath it is included
+        self.assert_(not m.is_pruned('/var/cache'))
+
+if __name__ == "__main__":
+    unittest.main()
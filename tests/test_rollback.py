@@ -0,0 +1,151 @@
+#!/usr/bin/python
+"""
+Unit tests for rollback (no database server needed)
+
+Usage: python -m unittest discover -s tests -p 'test_*.py'
+"""
+import os
+from os.path import *
+
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import rollback
+from rollback import Rollback, Journal
+from dirindex import DirIndex
+
+class TestDatabaseLimits(unittest.TestCase):
+    def test_database_limits(self):
+        self.assertEquals(rollback._database_limits([]), [])
+        self.assertEquals(rollback._database_limits([ 'db', '-other' ]), [ 'db', '-other' ])
+
+        # tables need their whole database, excluded tables don't matter
+        self.assertEquals(rollback._database_limits([ 'db/t1', 'db/t2', '-db2/t' ]),
+                          [ 'db', 'db' ])
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_rollback-")
+        self.path = join(self.tmpdir, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        journal = Journal(self.path)
+        journal.add("/etc/hosts")
+        journal.add("rollback_database")
+        journal.close()
+
+        # interrupted while writing an entry
+        file(self.path, "a").write("/etc/pass")
+
+        journal = Journal(self.path)
+        self.assert_("/etc/hosts" in journal)
+        self.assert_("rollback_database" in journal)
+        self.assert_("/etc/pass" not in journal)
+        journal.close()
+
+    def test_add_after_torn_line(self):
+        file(self.path, "w").write("/etc/hosts\n/etc/pass")
+
+        journal = Journal(self.path)
+        journal.add("/etc/passwd")
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assert_("/etc/hosts" in journal)
+        self.assert_("/etc/passwd" in journal)
+
+class TestRollbackChange(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_rollback-")
+        self.rollback = Rollback.create(join(self.tmpdir, "rollback"))
+
+        self.path = join(self.tmpdir, "file")
+        file(self.path, "w").write("original")
+        os.chmod(self.path, 0600)
+
+        self.dirindex = DirIndex()
+        self.dirindex.add_path(self.path)
+        self.dirindex[self.path].uid += 1
+
+        # the original, as the restore left it in originals
+        self.rollback._snapshot_to_originals(self.path)
+        os.chmod(self.path, 0644)
+        os.rename(self.path, self.path + ".restored")
+
+        self.lchowns = []
+        def lchown(path, uid, gid):
+            self.lchowns.append(path)
+            if len(self.lchowns) == 1:
+                raise OSError("interrupted")
+
+        self.lchown = os.lchown
+        os.lchown = lchown
+
+    def tearDown(self):
+        os.lchown = self.lchown
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume_after_rename(self):
+        self.assertRaises(OSError, self.rollback._rollback_change,
+                          self.path, 'o', self.dirindex)
+        self.assertEquals(file(self.path).read(), "original")
+
+        self.rollback._rollback_change(self.path, 'o', self.dirindex)
+        self.assertEquals(self.lchowns, [ self.path, self.path ])
+        self.assertEquals(os.stat(self.path).st_mode & 0777, 0600)
+
+class TestRollbackResume(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_rollback-")
+        self.path = join(self.tmpdir, "rollback")
+        Rollback.create(self.path)
+
+        self.calls = []
+        self.failing = set()
+
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def rollback(self):
+        r = Rollback(self.path)
+        def step(name):
+            def method(*args):
+                self.calls.append(name)
+                if name in self.failing:
+                    raise Exception(name + " failed")
+            method.__name__ = name
+            return method
+
+        for name in ('rollback_database', 'rollback_files', 'rollback_new_packages'):
+            setattr(r, name, step(name))
+
+        r.rollback()
+
+    def test_resume_after_failure(self):
+        self.failing.add('rollback_files')
+        self.assertRaises(rollback.Error, self.rollback)
+        self.assert_(exists(self.path))
+
+        self.failing.clear()
+        self.rollback()
+
+        self.assertEquals(self.calls, [ 'rollback_database', 'rollback_files',
+                                        'rollback_new_packages', 'rollback_files' ])
+
+        # deleted once it succeeds
+        self.assert_(not exists(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+"""
+Benchmark DirIndex.walk against the legacy listdir/islink/isdir/lstat walker
+on a synthetic tree. Prints syscall counts and wall-clock time.
+
+Then benchmarks apply_actions on the tree: a chown and chmod of every path,
+and a mkdir, chown and chmod of every directory in a copy of the tree.
+Every action can be delayed by latency-ms (e.g., to simulate network storage).
+
+Usage: walkbench.py [ dirs-per-level depth files-per-dir [ latency-ms ] ]
+"""
+import os
+from os.path import *
+
+import sys
+import stat
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+import dirindex
+from dirindex import DirIndex
+from pathmap import PathMap
+from changes import Changes, apply_actions, mkdir, APPLY_WORKERS
+
+class Counter(dict):
+    def wrap(self, mod, name):
+        func = getattr(mod, name)
+        def wrapper(*args, **kws):
+            self[name] = self.get(name, 0) + 1
+            return func(*args, **kws)
+        setattr(mod, name, wrapper)
+        return func
+
+def mktree(root, fanout, depth, nfiles):
+    for i in range(nfiles):
+        file(join(root, "file%d" % i), "w").write("x" * i)
+    os.symlink("file0", join(root, "link"))
+
+    if depth == 0:
+        return
+
+    for i in range(fanout):
+        path = join(root, "dir%d" % i)
+        os.mkdir(path)
+        mktree(path, fanout, depth - 1, nfiles)
+
+def legacy_walk(di, *paths):
+    pathmap = PathMap(paths)
+
+    def _walk(dir):
+        dentries = []
+
+        for dentry in os.listdir(dir):
+            path = join(dir, dentry)
+            if path in pathmap.excludes:
+                continue
+
+            dentries.append(dentry)
+
+            if not islink(path) and isdir(path):
+                for val in _walk(path):
+                    yield val
+
+        yield dir, dentries
+
+    for path in pathmap.includes:
+        if not lexists(path):
+            continue
+
+        di.add_path(path)
+
+        if islink(path) or not isdir(path):
+            continue
+
+        for dpath, dentries in _walk(path):
+            for dentry in dentries:
+                di.add_path(join(dpath, dentry))
+
+def bench(name, walk, root):
+    counter = Counter()
+    funcs = [ (funcname, counter.wrap(os, funcname))
+              for funcname in ('lstat', 'stat', 'listdir', 'readlink') ]
+
+    di = DirIndex()
+    started = time.time()
+    try:
+        walk(di, root)
+    finally:
+        for funcname, func in funcs:
+            setattr(os, funcname, func)
+
+    elapsed = time.time() - started
+    calls = sum(counter.values())
+    print "%-8s %8d entries %8d calls (%s) %8.3f sec" % \
+          (name, len(di), calls,
+           ", ".join("%s=%d" % (k, v) for k, v in sorted(counter.items())),
+           elapsed)
+
+    return di
+
+class Action(Changes.Action):
+    latency = 0
+
+    def __call__(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return Changes.Action.__call__(self)
+
+def apply_bench(name, actions, workers):
+    started = time.time()
+    apply_actions(actions, workers)
+    elapsed = time.time() - started
+
+    print "%-8s %8d actions %8d workers %8.3f sec" % (name, len(actions), workers, elapsed)
+
+def statfixes(di):
+    actions = []
+    for path in sorted(di):
+        rec = di[path]
+        actions.append(Action(os.lchown, path, rec.uid, rec.gid))
+        if not stat.S_ISLNK(rec.mod):
+            actions.append(Action(os.chmod, path, stat.S_IMODE(rec.mod)))
+
+    return actions
+
+def mkdirs(di, root, dest):
+    actions = []
+    for path in sorted(di):
+        rec = di[path]
+        if stat.S_ISDIR(rec.mod):
+            path = dest + path[len(root):]
+            actions += [ Action(mkdir, path),
+                         Action(os.lchown, path, rec.uid, rec.gid),
+                         Action(os.chmod, path, stat.S_IMODE(rec.mod)) ]
+
+    return actions
+
+def main():
+    args = map(int, sys.argv[1:]) or [ 8, 3, 50 ]
+    if len(args) == 4:
+        Action.latency = args.pop() / 1000.0
+
+    if len(args) != 3:
+        print >> sys.stderr, __doc__.strip()
+        sys.exit(1)
+
+    root = tempfile.mkdtemp(prefix="walkbench-")
+    try:
+        mktree(root, *args)
+        print "scandir: " + ("yes" if dirindex.scandir else "no (listdir + lstat fallback)")
+
+        a = bench("legacy", legacy_walk, root)
+        b = bench("walk", DirIndex.walk, root)
+
+        assert sorted(rec.fmt() for rec in a.values()) == \
+               sorted(rec.fmt() for rec in b.values()), "index mismatch"
+
+        for workers in (1, APPLY_WORKERS):
+            apply_bench("statfix", statfixes(b), workers)
+
+        for workers in (1, APPLY_WORKERS):
+            dest = tempfile.mkdtemp(prefix="walkbench-")
+            try:
+                apply_bench("mkdir", mkdirs(b, root, dest), workers)
+            finally:
+                shutil.rmtree(dest)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()